@@ -42,14 +42,18 @@ for f in "$RECORDING_DIR"/*.mka; do
     fi
 done
 
-# Step 2: Transcribe each audio file
+# Step 2: Transcribe all audio files (streamed to Parakeet concurrently)
 echo "[🗣️] Transcribing audio files..."
+WAV_FILES=()
 for wav in "$RECORDING_DIR"/*.wav; do
     if [ -f "$wav" ]; then
         echo "[📝] Transcribing: $wav"
-        python3 /pipeline/send_to_parakeet.py "$wav"
+        WAV_FILES+=("$wav")
     fi
 done
+if [ ${#WAV_FILES[@]} -gt 0 ]; then
+    python3 /pipeline/send_to_parakeet.py "${WAV_FILES[@]}"
+fi
 
 # Step 3: Retrieve consultation data from telesalud
 echo "[🏥] Retrieving consultation data..."
@@ -67,7 +71,7 @@ python3 /pipeline/merge_transcripts.py "$RECORDING_DIR"
 
 # Step 6: Summarize with Ollama
 echo "[🤖] Generating AI summary..."
-if [ -f "$RECORDING_DIR/final_merged.json" ]; then
+if [ -f "$RECORDING_DIR/final_merged.json" ] || [ -f "$RECORDING_DIR/final_merged.json.gz" ]; then
     python3 /pipeline/summarize_with_ollama.py "$RECORDING_DIR/final_merged.json"
 else
     echo "[⚠️] No merged transcript found, skipping summarization"
@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+"""
+HTTP helpers shared by the pipeline scripts
+Pooled requests sessions that retry transient upstream failures
+"""
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) timeout in seconds
+DEFAULT_TIMEOUT = (3.05, 30)
+
+
+def create_session(pool_connections=4, pool_maxsize=32):
+    """Create a keep-alive session that retries 502/503/504 and connection errors"""
+    retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retries)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
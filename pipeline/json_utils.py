@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+JSON helpers shared by the pipeline scripts
+Uses orjson when it is installed and falls back to the stdlib json module
+"""
+import gzip
+import json
+import os
+import tempfile
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so one except clause covers both
+JSONDecodeError = json.JSONDecodeError
+
+GZIP_SUFFIX = '.gz'
+# Write large pipeline outputs (merged transcript, clinical summary) as .json.gz
+GZIP_OUTPUTS = os.environ.get("GZIP_JSON_OUTPUTS", "false").lower() == "true"
+
+
+def loads(data):
+    """Parse JSON from str or bytes"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj, indent=False):
+    """Serialize obj to UTF-8 encoded JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else None)
+    return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False).encode('utf-8')
+
+
+def open_binary(path):
+    """Open a JSON file for reading, decompressing it if the name ends in .gz"""
+    if os.fspath(path).endswith(GZIP_SUFFIX):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def existing(path):
+    """Return path, or its .gz sibling when only the compressed copy exists"""
+    path = os.fspath(path)
+    if not os.path.exists(path) and os.path.exists(path + GZIP_SUFFIX):
+        return path + GZIP_SUFFIX
+    return path
+
+
+def load(path):
+    """Read and parse a JSON file (plain or .gz)"""
+    with open_binary(path) as f:
+        return loads(f.read())
+
+
+def dump(obj, path, indent=True):
+    """Serialize obj and write it to path"""
+    with open(path, 'wb') as f:
+        f.write(dumps(obj, indent=indent))
+
+
+def atomic_write_bytes(path, data):
+    """Write data to path via a fsynced temp file and rename, so readers never see a partial file"""
+    path = os.fspath(path)
+    directory = os.path.dirname(path) or '.'
+    # A unique temp file per writer, so concurrent writers of the same path can't clobber each other's
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        try:
+            os.fchmod(fd, 0o644)  # mkstemp creates files 0600
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    
+    # Persist the rename itself
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def dump_atomic(obj, path, indent=True):
+    """Serialize obj and atomically replace path with it, gzip-compressed if the name ends in .gz"""
+    data = dumps(obj, indent=indent)
+    if os.fspath(path).endswith(GZIP_SUFFIX):
+        data = gzip.compress(data, compresslevel=3)
+    atomic_write_bytes(path, data)
+
+
+def dump_output(obj, path):
+    """
+    Write a pipeline output as path, or path.gz when GZIP_JSON_OUTPUTS is on
+    The other variant is removed so readers never pick up a stale copy; returns the path written
+    """
+    path = os.fspath(path)
+    target, stale = (path + GZIP_SUFFIX, path) if GZIP_OUTPUTS else (path, path + GZIP_SUFFIX)
+    dump_atomic(obj, target)
+    try:
+        os.remove(stale)
+    except FileNotFoundError:
+        pass
+    return target
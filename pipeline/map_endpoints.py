@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 import sys
-import json
 import os
-import requests
+import http_utils
+import json_utils
 
 PROSODY_API_URL = os.environ.get("PROSODY_API_URL", "http://prosody:5280/event_sync")
 
+_SESSION = http_utils.create_session()
+
 def map_endpoints_from_prosody(event_log_file):
     """Map Jitsi endpoints to speaker names using Prosody event logs"""
     
@@ -16,8 +18,7 @@ def map_endpoints_from_prosody(event_log_file):
     # Try to load event log if it exists
     if os.path.exists(event_log_file):
         try:
-            with open(event_log_file, 'r') as f:
-                events = json.load(f)
+            events = json_utils.load(event_log_file)
             
             # Parse events to extract participant info
             participants = {}
@@ -47,9 +48,10 @@ def map_endpoints_from_prosody(event_log_file):
             # Extract room name from log file name
             room_name = os.path.basename(event_log_file).replace('.json', '')
             
-            response = requests.get(f"{PROSODY_API_URL}/room/{room_name}/participants")
+            response = _SESSION.get(f"{PROSODY_API_URL}/room/{room_name}/participants",
+                                    timeout=http_utils.DEFAULT_TIMEOUT)
             if response.status_code == 200:
-                participants = response.json()
+                participants = json_utils.loads(response.content)
                 
                 for idx, participant in enumerate(participants):
                     speaker_key = f"speaker{idx + 1}"
@@ -73,8 +75,7 @@ def map_endpoints_from_prosody(event_log_file):
         
     output_file = os.path.join(recording_dir, "speaker_mapping.json")
     
-    with open(output_file, 'w') as f:
-        json.dump(speaker_mapping, f, indent=2)
+    json_utils.dump_atomic(speaker_mapping, output_file)
     
     print(f"[✅] Saved speaker mapping to {output_file}")
     print(f"[👥] Mapping: {speaker_mapping}")
@@ -1,16 +1,39 @@
 #!/usr/bin/env python3
 import sys
-import json
 import os
-import glob
+import functools
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+import json_utils
+
+# Threads used to read and parse the per-speaker transcript files
+LOAD_WORKERS = 8
+
+@functools.lru_cache(maxsize=256)
+def _load_mapping(path, mtime_ns):
+    """Parse a speaker mapping file; mtime_ns in the key drops stale entries after a rewrite"""
+    return json_utils.load(path)
+
+def load_speaker_mapping(speaker_map_file):
+    """Load speaker_mapping.json, reusing the parsed copy while the file is unchanged"""
+    try:
+        mtime_ns = os.stat(speaker_map_file).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    return _load_mapping(speaker_map_file, mtime_ns)
 
 def merge_transcripts(recording_dir):
     """Merge individual transcript files with speaker mapping"""
     
     print(f"[🔀 MERGE] Merging transcripts in {recording_dir}")
     
-    # Find all transcript files
-    transcript_files = glob.glob(os.path.join(recording_dir, "*_transcript.json"))
+    # Find all transcript files (scandir reuses the directory entry type, no stat per file)
+    with os.scandir(recording_dir) as entries:
+        transcript_files = sorted(
+            entry.path for entry in entries
+            if entry.name.endswith("_transcript.json") and entry.is_file()
+        )
     
     if not transcript_files:
         print("[⚠️] No transcript files found")
@@ -18,11 +41,9 @@ def merge_transcripts(recording_dir):
     
     # Load speaker mapping if available
     speaker_map_file = os.path.join(recording_dir, "speaker_mapping.json")
-    speaker_mapping = {}
+    speaker_mapping = load_speaker_mapping(speaker_map_file)
     
-    if os.path.exists(speaker_map_file):
-        with open(speaker_map_file, 'r') as f:
-            speaker_mapping = json.load(f)
+    if speaker_mapping:
         print(f"[👥] Loaded speaker mapping: {speaker_mapping}")
     
     # Merge all transcripts
@@ -31,11 +52,14 @@ def merge_transcripts(recording_dir):
         "speakers": [],
         "full_transcript": []
     }
+    # Per-speaker segment lists, each already in time order from Parakeet
+    speaker_streams = []
     
-    for transcript_file in sorted(transcript_files):
-        with open(transcript_file, 'r') as f:
-            data = json.load(f)
-        
+    # Read and parse all speaker files in parallel; results come back in sorted file order
+    with ThreadPoolExecutor(max_workers=min(LOAD_WORKERS, len(transcript_files))) as executor:
+        loaded = list(executor.map(json_utils.load, transcript_files))
+    
+    for transcript_file, data in zip(transcript_files, loaded):
         # Extract speaker info from filename (e.g., speaker1_transcript.json)
         filename = os.path.basename(transcript_file)
         speaker_id = filename.split('_')[0]
@@ -43,60 +67,62 @@ def merge_transcripts(recording_dir):
         # Get speaker name from mapping or use ID
         speaker_name = speaker_mapping.get(speaker_id, speaker_id)
         
-        # Combine all transcript segments
-        full_text = " ".join([t.get('text', '') for t in data.get('transcripts', [])])
+        segments = data.get('transcripts', ())
+        
+        # Combine all transcript segments, skipping ones without text
+        full_text = " ".join(t['text'] for t in segments if t.get('text'))
         
         speaker_data = {
             "speaker_id": speaker_id,
             "speaker_name": speaker_name,
             "file": data.get('file', ''),
             "text": full_text,
-            "segments": data.get('transcripts', [])
+            "segments": segments
         }
         
         merged_transcript["speakers"].append(speaker_data)
         
         # Add to full transcript with speaker labels
-        for segment in data.get('transcripts', []):
-            if 'text' in segment:
-                merged_transcript["full_transcript"].append({
-                    "speaker": speaker_name,
-                    "text": segment['text'],
-                    "timestamp": segment.get('timestamp', '')
-                })
+        stream = [
+            {
+                "speaker": speaker_name,
+                "text": segment['text'],
+                "timestamp": segment.get('timestamp', '')
+            }
+            for segment in segments
+            if 'text' in segment
+        ]
+        # heapq.merge needs each stream in timestamp order; segments normally already are,
+        # which makes this (stable) sort a linear pass
+        stream.sort(key=itemgetter('timestamp'))
+        speaker_streams.append(stream)
     
-    # Sort full transcript by timestamp if available
-    if all('timestamp' in s for s in merged_transcript["full_transcript"]):
-        merged_transcript["full_transcript"].sort(key=lambda x: x.get('timestamp', ''))
+    # k-way merge of the sorted speaker streams into one timeline
+    merged_transcript["full_transcript"] = list(heapq.merge(*speaker_streams, key=itemgetter('timestamp')))
     
     # Save merged transcript
-    output_file = os.path.join(recording_dir, "final_merged.json")
-    with open(output_file, 'w') as f:
-        json.dump(merged_transcript, f, indent=2)
+    output_file = json_utils.dump_output(merged_transcript, os.path.join(recording_dir, "final_merged.json"))
     
     print(f"[✅] Saved merged transcript to {output_file}")
     
     # Also create a simple text version
     text_output = os.path.join(recording_dir, "transcript.txt")
-    with open(text_output, 'w') as f:
-        f.write(f"Recording: {merged_transcript['recording_id']}\n")
-        f.write("=" * 50 + "\n\n")
-        
-        for entry in merged_transcript["full_transcript"]:
-            f.write(f"{entry['speaker']}: {entry['text']}\n")
-        
-        f.write("\n" + "=" * 50 + "\n")
-        f.write("Individual Speaker Summaries:\n\n")
-        
-        for speaker in merged_transcript["speakers"]:
-            f.write(f"{speaker['speaker_name']}:\n")
-            f.write(f"{speaker['text']}\n\n")
+    lines = [f"Recording: {merged_transcript['recording_id']}\n", "=" * 50 + "\n\n"]
+    lines.extend(f"{entry['speaker']}: {entry['text']}\n" for entry in merged_transcript["full_transcript"])
+    lines.append("\n" + "=" * 50 + "\n")
+    lines.append("Individual Speaker Summaries:\n\n")
+    lines.extend(f"{speaker['speaker_name']}:\n{speaker['text']}\n\n" for speaker in merged_transcript["speakers"])
+    
+    # Build the whole file in memory and write it in one call, replacing any previous version atomically
+    json_utils.atomic_write_bytes(text_output, "".join(lines).encode('utf-8'))
     
     print(f"[✅] Saved text transcript to {text_output}")
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print("Usage: merge_transcripts.py <recording_dir>")
+        print("Usage: merge_transcripts.py <recording_dir> [<recording_dir> ...]")
         sys.exit(1)
     
-    merge_transcripts(sys.argv[1])
\ No newline at end of file
+    # One process can merge many recordings and share the mapping cache
+    for recording_dir in sys.argv[1:]:
+        merge_transcripts(recording_dir)
\ No newline at end of file
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Index of consultation metadata files in METADATA_DIR
+Lets the pipeline find a consultation's metadata without opening every *_metadata.json
+"""
+import fcntl
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import json_utils
+
+# Only ever read by code, so it is written without indentation
+INDEX_FILENAME = "metadata_index.json"
+LOCK_FILENAME = "metadata_index.lock"
+METADATA_SUFFIX = "_metadata.json"
+# Threads used to read metadata files when the index has to be rebuilt
+SCAN_WORKERS = 8
+
+
+def _load_metadata(filepath):
+    try:
+        return json_utils.load(filepath)
+    except Exception as e:
+        print(f"[⚠️] Error reading metadata {os.path.basename(filepath)}: {e}")
+        return None
+
+
+class MetadataIndex:
+    """
+    consultation_id -> {file, status, topic, webhook_received, recording_processed}, stored as one JSON file
+    Writers update it under a file lock; if it doesn't exist yet it is rebuilt from a directory scan
+    """
+
+    def __init__(self, metadata_dir=None):
+        self.metadata_dir = metadata_dir or os.environ.get("METADATA_DIR", "/shared/consultations")
+        self.index_file = os.path.join(self.metadata_dir, INDEX_FILENAME)
+        self._entries = None
+
+    @contextmanager
+    def _locked(self):
+        """Hold an exclusive lock on the index across processes"""
+        with open(os.path.join(self.metadata_dir, LOCK_FILENAME), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _read(self):
+        try:
+            entries = json_utils.load(self.index_file)
+        except (OSError, json_utils.JSONDecodeError):
+            return None
+        # Indexes written before status/topic were tracked get rebuilt from the metadata files
+        if any('topic' not in entry for entry in entries.values()):
+            return None
+        return entries
+
+    def _metadata_files(self):
+        """List *_metadata.json entries; scandir supplies the name and file type without a stat per file"""
+        with os.scandir(self.metadata_dir) as it:
+            return [
+                entry for entry in it
+                if entry.name.endswith(METADATA_SUFFIX) and entry.is_file(follow_symlinks=False)
+            ]
+
+    def _scan(self):
+        """Build index entries by reading every metadata file (the old lookup path)"""
+        paths = [entry.path for entry in self._metadata_files()]
+        
+        # Files are independent; read and parse them in parallel
+        with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+            loaded = list(executor.map(_load_metadata, paths))
+        
+        entries = {}
+        for filepath, metadata in zip(paths, loaded):
+            consultation_id = metadata.get('consultation_id') if metadata else None
+            if consultation_id:
+                entries[consultation_id] = self._entry(os.path.basename(filepath), metadata)
+        return entries
+
+    @staticmethod
+    def _entry(filename, metadata):
+        return {
+            'file': filename,
+            'status': metadata.get('status'),
+            'topic': metadata.get('topic'),
+            'webhook_received': metadata.get('webhook_received'),
+            'recording_processed': metadata.get('recording_processed', False)
+        }
+
+    def _load_or_rebuild(self):
+        entries = self._read()
+        if entries is None:
+            entries = self._scan()
+            json_utils.dump_atomic(entries, self.index_file, indent=False)
+            print(f"[🗂️ INDEX] Rebuilt metadata index with {len(entries)} consultations")
+        return entries
+
+    def entries(self):
+        """Return the index, read once per instance"""
+        if self._entries is None:
+            if not os.path.isdir(self.metadata_dir):
+                return {}
+            self._entries = self._read()
+            if self._entries is None:
+                try:
+                    with self._locked():
+                        self._entries = self._load_or_rebuild()
+                except OSError as e:
+                    # e.g. a read-only METADATA_DIR: the index is only a shortcut, so read the files directly
+                    print(f"[⚠️] Metadata index unavailable ({e}), scanning metadata files instead")
+                    self._entries = self._scan()
+        return self._entries
+
+    def put(self, consultation_id, filepath, metadata):
+        """Record (or update) the metadata file for a consultation and the fields listed from the index"""
+        try:
+            with self._locked():
+                entries = self._load_or_rebuild()
+                entries[consultation_id] = self._entry(os.path.basename(filepath), metadata)
+                json_utils.dump_atomic(entries, self.index_file, indent=False)
+        except OSError as e:
+            # The metadata file itself is already written; a missing index entry is picked up by the next scan
+            print(f"[⚠️] Could not update metadata index for {consultation_id}: {e}")
+            self._entries = None
+            return
+        self._entries = entries
+
+    def load(self, consultation_id):
+        """Return (metadata, filepath) for an indexed consultation"""
+        filepath = os.path.join(self.metadata_dir, self.entries()[consultation_id]['file'])
+        return json_utils.load(filepath), filepath
+
+    @staticmethod
+    def _matches(consultation_id, recording_id):
+        return consultation_id in recording_id or recording_id in consultation_id
+
+    def _find_unindexed(self, recording_id):
+        """Match recording_id against {consultation_id}_metadata.json names missing from the index"""
+        entries = self.entries()
+        names = [entry.name for entry in self._metadata_files()]
+        
+        for name in names:
+            consultation_id = name[:-len(METADATA_SUFFIX)]
+            if consultation_id in entries or not self._matches(consultation_id, recording_id):
+                continue
+            filepath = os.path.join(self.metadata_dir, name)
+            try:
+                metadata = json_utils.load(filepath)
+            except Exception as e:
+                print(f"[⚠️] Error reading metadata {name}: {e}")
+                continue
+            self.put(metadata.get('consultation_id') or consultation_id, filepath, metadata)
+            return metadata, filepath
+        return None, None
+
+    def find(self, recording_id):
+        """Return (metadata, filepath) for the consultation whose ID matches the recording, or (None, None)"""
+        # Recording directories are usually named after the consultation; try its file before reading the index
+        filepath = os.path.join(self.metadata_dir, f"{recording_id}{METADATA_SUFFIX}")
+        try:
+            return json_utils.load(filepath), filepath
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"[⚠️] Error reading metadata for {recording_id}: {e}")
+        
+        try:
+            for consultation_id in self.entries():
+                if self._matches(consultation_id, recording_id):
+                    try:
+                        return self.load(consultation_id)
+                    except Exception as e:
+                        print(f"[⚠️] Error reading metadata for {consultation_id}: {e}")
+            
+            # Metadata written without going through the index; the filename carries the ID
+            if os.path.isdir(self.metadata_dir):
+                return self._find_unindexed(recording_id)
+        except OSError as e:
+            print(f"[⚠️] Error searching metadata for {recording_id}: {e}")
+        return None, None
+
+    def most_recent_unprocessed(self):
+        """Return (metadata, filepath) for the most recently received unprocessed consultation, or (None, None)"""
+        unprocessed = [
+            (entry.get('webhook_received') or '', consultation_id)
+            for consultation_id, entry in self.entries().items()
+            if not entry.get('recording_processed', False)
+        ]
+        for _, consultation_id in sorted(unprocessed, reverse=True):
+            try:
+                return self.load(consultation_id)
+            except Exception as e:
+                print(f"[⚠️] Error reading metadata for {consultation_id}: {e}")
+        return None, None
@@ -1,14 +1,17 @@
 #!/usr/bin/env python3
 import sys
 import os
-import requests
-import json
+import shutil
 from datetime import datetime
+import http_utils
+import json_utils
 
 OPENEMR_API_URL = os.environ.get("OPENEMR_API_URL", "http://openemr:80/apis/default/api")
 OPENEMR_API_KEY = os.environ.get("OPENEMR_API_KEY", "")
 PATIENT_ID = os.environ.get("PATIENT_ID", "")
 
+_SESSION = http_utils.create_session()
+
 def send_to_openemr(note_file):
     """Send clinical note to OpenEMR via API"""
     
@@ -55,23 +58,23 @@ def send_to_openemr(note_file):
             # Add to unassigned notes queue
             endpoint = f"{OPENEMR_API_URL}/document/unassigned"
         
-        # Send to OpenEMR
-        response = requests.post(endpoint, json=note_data, headers=headers)
+        # Send to OpenEMR (body pre-serialized, headers already declare JSON)
+        response = _SESSION.post(endpoint, data=json_utils.dumps(note_data), headers=headers,
+                                 timeout=http_utils.DEFAULT_TIMEOUT)
         
         if response.status_code in [200, 201]:
-            result = response.json()
+            result = json_utils.loads(response.content)
             document_id = result.get('document_id', 'unknown')
             print(f"[✅] Successfully sent to OpenEMR. Document ID: {document_id}")
             
             # Save confirmation
             confirmation_file = os.path.join(recording_dir, "openemr_upload.json")
-            with open(confirmation_file, 'w') as f:
-                json.dump({
-                    "status": "success",
-                    "document_id": document_id,
-                    "timestamp": datetime.now().isoformat(),
-                    "patient_id": PATIENT_ID or "unassigned"
-                }, f, indent=2)
+            json_utils.dump({
+                "status": "success",
+                "document_id": document_id,
+                "timestamp": datetime.now().isoformat(),
+                "patient_id": PATIENT_ID or "unassigned"
+            }, confirmation_file)
                 
         else:
             print(f"[❌] Error from OpenEMR API: {response.status_code}")
@@ -79,25 +82,23 @@ def send_to_openemr(note_file):
             
             # Save error details
             error_file = os.path.join(recording_dir, "openemr_error.json")
-            with open(error_file, 'w') as f:
-                json.dump({
-                    "status": "error",
-                    "status_code": response.status_code,
-                    "error": response.text,
-                    "timestamp": datetime.now().isoformat()
-                }, f, indent=2)
+            json_utils.dump({
+                "status": "error",
+                "status_code": response.status_code,
+                "error": response.text,
+                "timestamp": datetime.now().isoformat()
+            }, error_file)
             
     except Exception as e:
         print(f"[❌] Error sending to OpenEMR: {e}")
         
         # Save error details
         error_file = os.path.join(recording_dir, "openemr_error.json")
-        with open(error_file, 'w') as f:
-            json.dump({
-                "status": "error",
-                "error": str(e),
-                "timestamp": datetime.now().isoformat()
-            }, f, indent=2)
+        json_utils.dump({
+            "status": "error",
+            "error": str(e),
+            "timestamp": datetime.now().isoformat()
+        }, error_file)
     
     # Alternative: Save to shared directory for manual import
     shared_dir = os.environ.get("SHARED_NOTES_DIR", "/shared/notes")
@@ -108,10 +109,8 @@ def send_to_openemr(note_file):
             shared_filename = f"telehealth_note_{recording_id}_{timestamp}.txt"
             shared_path = os.path.join(shared_dir, shared_filename)
             
-            # Copy note to shared directory
-            with open(note_file, 'r') as src:
-                with open(shared_path, 'w') as dst:
-                    dst.write(src.read())
+            # Copy note to shared directory (in-kernel sendfile copy on Linux)
+            shutil.copyfile(note_file, shared_path)
             
             print(f"[📁] Also saved to shared directory: {shared_path}")
             
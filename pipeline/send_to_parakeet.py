@@ -1,84 +1,99 @@
 #!/usr/bin/env python3
 import sys
-import json
-import websocket
+import asyncio
+import websockets
 import wave
 import os
-from threading import Thread
+import json_utils
 
 PARAKEET_WS_URL = os.environ.get("PARAKEET_WS_URL", "ws://parakeet-asr:8000/ws/transcribe")
+# Frames per WebSocket message (16384 frames = ~1s of 16kHz audio); larger chunks mean fewer sends and frame headers
+CHUNK_FRAMES = int(os.environ.get("PARAKEET_CHUNK_FRAMES", 16384))
+# Seconds to keep receiving after end_of_audio before closing the connection ourselves
+DRAIN_TIMEOUT = float(os.environ.get("PARAKEET_DRAIN_TIMEOUT", 10))
 
-def send_to_parakeet(wav_file):
+async def send_audio(ws, wav_file):
+    """Send audio config, WAV frames and the end-of-audio marker"""
+    config = {
+        "config": {
+            "sample_rate": 16000,
+            "language": "en",
+            "encoding": "LINEAR16"
+        }
+    }
+    # Control messages go out as text frames; audio goes out as binary frames
+    await ws.send(json_utils.dumps(config).decode())
+
+    with wave.open(wav_file, 'rb') as wav:
+        while True:
+            data = wav.readframes(CHUNK_FRAMES)
+            if not data:
+                break
+            await ws.send(data)
+
+    # Signal end of audio
+    await ws.send(json_utils.dumps({"action": "end_of_audio"}).decode())
+
+async def receive_transcripts(ws, transcripts):
+    """Collect transcription messages until the connection closes"""
+    try:
+        async for message in ws:
+            try:
+                data = json_utils.loads(message)
+                if 'text' in data:
+                    transcripts.append(data)
+                    print(f"[📝] Partial: {data.get('text', '')}")
+            except json_utils.JSONDecodeError:
+                print(f"[⚠️] Failed to parse message: {message}")
+    except websockets.exceptions.ConnectionClosedError as e:
+        print(f"[❌ ERROR] WebSocket error: {e}")
+
+async def transcribe(wav_file):
     """Send WAV file to Parakeet ASR via WebSocket and save transcription"""
-    
+
     print(f"[🎤 ASR] Transcribing {wav_file}")
-    
+
     # Output file for transcription
     output_file = wav_file.replace('.wav', '_transcript.json')
     transcripts = []
-    
-    def on_message(ws, message):
-        """Handle incoming transcription messages"""
-        try:
-            data = json.loads(message)
-            if 'text' in data:
-                transcripts.append(data)
-                print(f"[📝] Partial: {data.get('text', '')}")
-        except json.JSONDecodeError:
-            print(f"[⚠️] Failed to parse message: {message}")
-    
-    def on_error(ws, error):
-        print(f"[❌ ERROR] WebSocket error: {error}")
-    
-    def on_close(ws, close_status_code, close_msg):
+
+    try:
+        async with websockets.connect(PARAKEET_WS_URL) as ws:
+            # Sender and receiver share the event loop; no helper thread needed
+            receiver = asyncio.create_task(receive_transcripts(ws, transcripts))
+            await send_audio(ws, wav_file)
+            # Give Parakeet time to flush the final transcripts before closing
+            try:
+                await asyncio.wait_for(asyncio.shield(receiver), DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+            await ws.close()
+            await receiver
         print(f"[🔌] WebSocket closed")
-        # Save all transcripts
-        with open(output_file, 'w') as f:
-            json.dump({
-                'file': os.path.basename(wav_file),
-                'transcripts': transcripts
-            }, f, indent=2)
-        print(f"[✅] Saved transcript to {output_file}")
-    
-    def on_open(ws):
-        def run():
-            # Send audio config
-            config = {
-                "config": {
-                    "sample_rate": 16000,
-                    "language": "en",
-                    "encoding": "LINEAR16"
-                }
-            }
-            ws.send(json.dumps(config))
-            
-            # Send audio data
-            with wave.open(wav_file, 'rb') as wav:
-                while True:
-                    data = wav.readframes(1024)
-                    if not data:
-                        break
-                    ws.send(data, websocket.ABNF.OPCODE_BINARY)
-            
-            # Signal end of audio
-            ws.send(json.dumps({"action": "end_of_audio"}))
-            ws.close()
-        
-        thread = Thread(target=run)
-        thread.start()
-    
-    # Connect to WebSocket
-    ws = websocket.WebSocketApp(PARAKEET_WS_URL,
-                                on_open=on_open,
-                                on_message=on_message,
-                                on_error=on_error,
-                                on_close=on_close)
-    
-    ws.run_forever()
+    except (OSError, websockets.exceptions.WebSocketException) as e:
+        print(f"[❌ ERROR] WebSocket error: {e}")
+
+    # Save all transcripts
+    json_utils.dump_atomic({
+        'file': os.path.basename(wav_file),
+        'transcripts': transcripts
+    }, output_file)
+    print(f"[✅] Saved transcript to {output_file}")
+
+async def transcribe_all(wav_files):
+    """Transcribe several WAV files concurrently over one event loop"""
+    results = await asyncio.gather(*(transcribe(wav_file) for wav_file in wav_files), return_exceptions=True)
+    for wav_file, result in zip(wav_files, results):
+        if isinstance(result, Exception):
+            print(f"[❌ ERROR] Failed to transcribe {wav_file}: {result}")
+
+def send_to_parakeet(wav_file):
+    """Send WAV file to Parakeet ASR via WebSocket and save transcription"""
+    asyncio.run(transcribe(wav_file))
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print("Usage: send_to_parakeet.py <wav_file>")
+        print("Usage: send_to_parakeet.py <wav_file> [<wav_file> ...]")
         sys.exit(1)
-    
-    send_to_parakeet(sys.argv[1])
\ No newline at end of file
+
+    asyncio.run(transcribe_all(sys.argv[1:]))
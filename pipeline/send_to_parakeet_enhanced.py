@@ -4,16 +4,44 @@ Enhanced Parakeet client that can handle both MKA and WAV files
 Attempts to send MKA directly if Parakeet supports it, otherwise uses WAV
 """
 import sys
-import json
-import websocket
+import asyncio
+import requests
+import websockets
+from websockets.extensions.permessage_deflate import ClientPerMessageDeflateFactory
 import wave
+import mmap
 import os
-import subprocess
-from threading import Thread
+import struct
 import tempfile
+import http_utils
+import json_utils
 
 PARAKEET_WS_URL = os.environ.get("PARAKEET_WS_URL", "ws://parakeet-asr:8000/ws/transcribe")
 PARAKEET_HTTP_URL = os.environ.get("PARAKEET_HTTP_URL", "http://parakeet-asr:8000/transcribe")
+# Seconds to keep receiving after end_of_audio before closing the connection ourselves
+DRAIN_TIMEOUT = float(os.environ.get("PARAKEET_DRAIN_TIMEOUT", 10))
+# Audio is coalesced into binary frames of about this size (fewer frame headers and socket writes)
+SEND_BATCH_BYTES = int(os.environ.get("PARAKEET_SEND_BATCH_BYTES", 65536))
+# Bytes per read from the ffmpeg pipe (Linux default pipe capacity)
+PIPE_READ_BYTES = 65536
+# Offer permessage-deflate for PCM audio; silence compresses well. Parakeet may decline, then frames go uncompressed
+PARAKEET_WS_DEFLATE = os.environ.get("PARAKEET_WS_DEFLATE", "true").lower() == "true"
+# Bytes the WebSocket may buffer before a send waits for the socket to drain
+WRITE_LIMIT = 2 ** 20
+# Pipe reads buffered between the ffmpeg reader and the WebSocket sender (caps memory at 4 x 64 KiB)
+PIPE_QUEUE_CHUNKS = 4
+# Codec used on the wire when streaming MKA through ffmpeg: pcm (default), opus or flac.
+# Only switch away from pcm if the Parakeet server accepts compressed audio.
+PARAKEET_WIRE_CODEC = os.environ.get("PARAKEET_WIRE_CODEC", "pcm").lower()
+
+# ffmpeg output arguments and the config "encoding" announced for each wire codec
+WIRE_CODECS = {
+    'pcm': (['-f', 's16le'], 'LINEAR16'),                                 # Raw PCM, 32 KB/s
+    'opus': (['-c:a', 'libopus', '-b:a', '24k', '-f', 'ogg'], 'OGG_OPUS'),  # ~1/10 the bytes
+    'flac': (['-c:a', 'flac', '-f', 'flac'], 'FLAC'),                     # Lossless, ~1/2 the bytes
+}
+
+_SESSION = http_utils.create_session(pool_maxsize=16)
 
 def check_file_format(file_path):
     """Determine if file is MKA or WAV"""
@@ -26,21 +54,23 @@ def try_send_mka_http(mka_file):
     This would be the ideal path if Parakeet supports it
     """
     try:
-        import requests
+        from requests_toolbelt.multipart.encoder import MultipartEncoder
 
         print(f"[🚀] Attempting to send MKA file directly to Parakeet...")
 
         with open(mka_file, 'rb') as f:
-            files = {'audio': (os.path.basename(mka_file), f, 'audio/x-matroska')}
-            response = requests.post(
+            # The encoder streams the multipart body from disk instead of building it in memory
+            encoder = MultipartEncoder(fields={'audio': (os.path.basename(mka_file), f, 'audio/x-matroska')})
+            response = _SESSION.post(
                 PARAKEET_HTTP_URL,
-                files=files,
+                data=encoder,
+                headers={'Content-Type': encoder.content_type},
                 timeout=300  # 5 minute timeout for large files
             )
 
         if response.status_code == 200:
             print(f"[✅] Parakeet successfully processed MKA file")
-            return response.json()
+            return json_utils.loads(response.content)
         else:
             print(f"[⚠️] Parakeet returned status {response.status_code}")
             return None
@@ -52,6 +82,184 @@ def try_send_mka_http(mka_file):
         print(f"[⚠️] Failed to send MKA via HTTP: {e}")
         return None
 
+def connect_parakeet(deflate=False):
+    """
+    Open a WebSocket connection to Parakeet
+    No message size cap (transcripts can be long) and a larger write buffer so audio sends rarely wait on drain
+    """
+    extensions = None
+    if deflate:
+        extensions = [ClientPerMessageDeflateFactory(server_max_window_bits=15,
+                                                     client_max_window_bits=15,
+                                                     client_no_context_takeover=False)]
+    return websockets.connect(PARAKEET_WS_URL,
+                              max_size=None,
+                              compression=None,
+                              extensions=extensions,
+                              write_limit=WRITE_LIMIT)
+
+def report_compression(ws, deflate):
+    """Note when permessage-deflate was offered but not negotiated"""
+    if deflate and not ws.extensions:
+        print(f"[ℹ️] Parakeet declined permessage-deflate, sending uncompressed audio")
+
+async def send_config(ws, encoding="LINEAR16"):
+    """Send audio config"""
+    config = {
+        "config": {
+            "sample_rate": 16000,
+            "language": "en",
+            "encoding": encoding
+        }
+    }
+    await ws.send(json_utils.dumps(config).decode())
+
+def handle_message(message, transcripts):
+    """Collect a transcription message"""
+    try:
+        data = json_utils.loads(message)
+        if 'text' in data:
+            transcripts.append(data)
+            print(f"[📝] Partial: {data.get('text', '')}")
+    except json_utils.JSONDecodeError:
+        print(f"[⚠️] Failed to parse message: {message}")
+
+async def receive_transcripts(ws, transcripts):
+    """Collect transcription messages until the connection closes"""
+    try:
+        async for message in ws:
+            handle_message(message, transcripts)
+    except websockets.exceptions.ConnectionClosedError as e:
+        print(f"[❌] WebSocket error: {e}")
+
+def wav_data_chunks(wav_file, chunk_size):
+    """
+    Yield the PCM payload of a WAV file in chunk_size slices of an mmap
+    The RIFF header is parsed once instead of going through wave.readframes per chunk
+    """
+    with open(wav_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm[0:4] != b'RIFF' or mm[8:12] != b'WAVE':
+            raise wave.Error(f"{wav_file} is not a RIFF/WAVE file")
+
+        # Walk the chunk list to the "data" chunk
+        offset = 12
+        while offset + 8 <= len(mm):
+            chunk_id = mm[offset:offset + 4]
+            size = struct.unpack_from('<I', mm, offset + 4)[0]
+            offset += 8
+            if chunk_id == b'data':
+                # Streamed WAVs may carry a placeholder size; never read past the file
+                end = min(offset + size, len(mm))
+                for start in range(offset, end, chunk_size):
+                    yield mm[start:min(start + chunk_size, end)]
+                return
+            # Chunks are padded to an even size
+            offset += size + (size & 1)
+
+        raise wave.Error(f"{wav_file} has no data chunk")
+
+async def read_pipe(stream, queue):
+    """Move ffmpeg output into the queue as soon as it is written, so ffmpeg never stalls on a full pipe"""
+    while True:
+        chunk = await stream.read(PIPE_READ_BYTES)
+        if not chunk:
+            break
+        await queue.put(chunk)
+    await queue.put(None)
+
+async def send_queued(ws, queue):
+    """Send queued audio, coalescing whatever is already waiting into frames of up to SEND_BATCH_BYTES"""
+    buf = bytearray()
+    while True:
+        chunk = await queue.get()
+        if chunk is None:
+            break
+        buf += chunk
+        while len(buf) < SEND_BATCH_BYTES and not queue.empty():
+            chunk = queue.get_nowait()
+            if chunk is None:
+                await queue.put(None)
+                break
+            buf += chunk
+        await ws.send(bytes(buf))
+        buf.clear()
+
+async def finish_stream(ws, receiver):
+    """Signal end of audio and give Parakeet time to flush the final transcripts before closing"""
+    await ws.send(json_utils.dumps({"action": "end_of_audio"}).decode())
+    try:
+        await asyncio.wait_for(asyncio.shield(receiver), DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        pass
+    await ws.close()
+    await receiver
+
+def save_transcripts(audio_file, transcripts, output_file):
+    """Save all transcripts"""
+    json_utils.dump_atomic({
+        'file': os.path.basename(audio_file),
+        'transcripts': transcripts
+    }, output_file)
+    print(f"[✅] Saved transcript to {output_file}")
+
+async def stream_audio(send_audio, encoding, transcripts):
+    """
+    Run one Parakeet session: config, send_audio(ws) while transcripts are received, then end of audio
+    Both senders go through here, so connection, compression and drain settings apply to each
+    """
+    # Compressed codecs gain nothing from a second deflate pass
+    deflate = PARAKEET_WS_DEFLATE and encoding == 'LINEAR16'
+    async with connect_parakeet(deflate) as ws:
+        report_compression(ws, deflate)
+        await send_config(ws, encoding)
+        receiver = asyncio.create_task(receive_transcripts(ws, transcripts))
+
+        await send_audio(ws)
+
+        await finish_stream(ws, receiver)
+    print(f"[🔌] WebSocket closed")
+
+def run_stream(audio_file, output_file, send_audio, encoding="LINEAR16"):
+    """Stream audio_file with send_audio and save whatever transcripts came back"""
+    transcripts = []
+
+    try:
+        asyncio.run(stream_audio(send_audio, encoding, transcripts))
+    except (OSError, websockets.exceptions.WebSocketException) as e:
+        print(f"[❌] WebSocket error: {e}")
+
+    save_transcripts(audio_file, transcripts, output_file)
+    return True
+
+async def send_wav_audio(ws, wav_file):
+    """Send the WAV payload"""
+    for chunk in wav_data_chunks(wav_file, SEND_BATCH_BYTES):
+        await ws.send(chunk)
+
+async def send_ffmpeg_audio(ws, mka_file, output_args):
+    """Convert MKA with ffmpeg and send its output; the bounded queue decouples ffmpeg from the socket"""
+    process = await asyncio.create_subprocess_exec(
+        'ffmpeg',
+        '-i', mka_file,
+        *output_args,
+        '-ar', '16000',  # 16kHz
+        '-ac', '1',      # Mono
+        '-',             # Output to stdout
+        '-loglevel', 'error',
+        stdout=asyncio.subprocess.PIPE
+    )
+
+    queue = asyncio.Queue(maxsize=PIPE_QUEUE_CHUNKS)
+    reader = asyncio.create_task(read_pipe(process.stdout, queue))
+    try:
+        await send_queued(ws, queue)
+    except BaseException:
+        reader.cancel()
+        process.kill()
+        raise
+    finally:
+        await process.wait()
+
 def stream_mka_via_websocket(mka_file, output_file):
     """
     Stream MKA file to Parakeet by converting on-the-fly with ffmpeg
@@ -59,143 +267,17 @@ def stream_mka_via_websocket(mka_file, output_file):
     """
     print(f"[🔄] Streaming MKA to Parakeet via ffmpeg pipe...")
 
-    transcripts = []
+    if PARAKEET_WIRE_CODEC not in WIRE_CODECS:
+        print(f"[⚠️] Unknown PARAKEET_WIRE_CODEC '{PARAKEET_WIRE_CODEC}', using pcm")
+    output_args, encoding = WIRE_CODECS.get(PARAKEET_WIRE_CODEC, WIRE_CODECS['pcm'])
 
-    def on_message(ws, message):
-        try:
-            data = json.loads(message)
-            if 'text' in data:
-                transcripts.append(data)
-                print(f"[📝] Partial: {data.get('text', '')}")
-        except json.JSONDecodeError:
-            print(f"[⚠️] Failed to parse message: {message}")
-
-    def on_error(ws, error):
-        print(f"[❌] WebSocket error: {error}")
-
-    def on_close(ws, close_status_code, close_msg):
-        print(f"[🔌] WebSocket closed")
-        with open(output_file, 'w') as f:
-            json.dump({
-                'file': os.path.basename(mka_file),
-                'transcripts': transcripts
-            }, f, indent=2)
-        print(f"[✅] Saved transcript to {output_file}")
-
-    def on_open(ws):
-        def run():
-            # Send audio config
-            config = {
-                "config": {
-                    "sample_rate": 16000,
-                    "language": "en",
-                    "encoding": "LINEAR16"
-                }
-            }
-            ws.send(json.dumps(config))
-
-            # Use ffmpeg to convert MKA to PCM on the fly
-            ffmpeg_cmd = [
-                'ffmpeg',
-                '-i', mka_file,
-                '-f', 's16le',  # Raw PCM
-                '-ar', '16000',  # 16kHz
-                '-ac', '1',      # Mono
-                '-',             # Output to stdout
-                '-loglevel', 'error'
-            ]
-
-            process = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.PIPE)
-
-            # Stream the converted audio
-            while True:
-                data = process.stdout.read(1024)
-                if not data:
-                    break
-                ws.send(data, websocket.ABNF.OPCODE_BINARY)
-
-            process.wait()
-
-            # Signal end of audio
-            ws.send(json.dumps({"action": "end_of_audio"}))
-            ws.close()
-
-        thread = Thread(target=run)
-        thread.start()
-
-    # Connect and stream
-    ws = websocket.WebSocketApp(PARAKEET_WS_URL,
-                                on_open=on_open,
-                                on_message=on_message,
-                                on_error=on_error,
-                                on_close=on_close)
-
-    ws.run_forever()
-    return True
+    return run_stream(mka_file, output_file, lambda ws: send_ffmpeg_audio(ws, mka_file, output_args), encoding)
 
 def send_wav_via_websocket(wav_file, output_file):
     """Original WAV sending method via WebSocket"""
     print(f"[🎤] Sending WAV file to Parakeet...")
 
-    transcripts = []
-
-    def on_message(ws, message):
-        try:
-            data = json.loads(message)
-            if 'text' in data:
-                transcripts.append(data)
-                print(f"[📝] Partial: {data.get('text', '')}")
-        except json.JSONDecodeError:
-            print(f"[⚠️] Failed to parse message: {message}")
-
-    def on_error(ws, error):
-        print(f"[❌] WebSocket error: {error}")
-
-    def on_close(ws, close_status_code, close_msg):
-        print(f"[🔌] WebSocket closed")
-        with open(output_file, 'w') as f:
-            json.dump({
-                'file': os.path.basename(wav_file),
-                'transcripts': transcripts
-            }, f, indent=2)
-        print(f"[✅] Saved transcript to {output_file}")
-
-    def on_open(ws):
-        def run():
-            # Send audio config
-            config = {
-                "config": {
-                    "sample_rate": 16000,
-                    "language": "en",
-                    "encoding": "LINEAR16"
-                }
-            }
-            ws.send(json.dumps(config))
-
-            # Send audio data
-            with wave.open(wav_file, 'rb') as wav:
-                while True:
-                    data = wav.readframes(1024)
-                    if not data:
-                        break
-                    ws.send(data, websocket.ABNF.OPCODE_BINARY)
-
-            # Signal end of audio
-            ws.send(json.dumps({"action": "end_of_audio"}))
-            ws.close()
-
-        thread = Thread(target=run)
-        thread.start()
-
-    # Connect to WebSocket
-    ws = websocket.WebSocketApp(PARAKEET_WS_URL,
-                                on_open=on_open,
-                                on_message=on_message,
-                                on_error=on_error,
-                                on_close=on_close)
-
-    ws.run_forever()
-    return True
+    return run_stream(wav_file, output_file, lambda ws: send_wav_audio(ws, wav_file))
 
 def send_to_parakeet(audio_file):
     """
@@ -212,8 +294,7 @@ def send_to_parakeet(audio_file):
         # Try 1: Send MKA directly via HTTP (if Parakeet supports it)
         result = try_send_mka_http(audio_file)
         if result:
-            with open(output_file, 'w') as f:
-                json.dump(result, f, indent=2)
+            json_utils.dump_atomic(result, output_file)
             return True
 
         # Try 2: Stream MKA via WebSocket with on-the-fly conversion
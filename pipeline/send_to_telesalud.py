@@ -4,58 +4,42 @@ Send clinical notes to telesalud module via evolution field API
 """
 import sys
 import os
-import json
-import requests
+import gzip
 from datetime import datetime
+import http_utils
+import json_utils
+from metadata_index import MetadataIndex
 
 TELESALUD_API_URL = os.environ.get("TELESALUD_API_URL", "http://telesalud-web/videoconsultation/evolution")
 TELESALUD_WEBHOOK_URL = os.environ.get("TELESALUD_WEBHOOK_URL", "http://telesalud-web/api/webhook/evolution")
 USE_WEBHOOK = os.environ.get("USE_WEBHOOK", "true").lower() == "true"
+# Gzip the webhook body; only enable if the telesalud server decompresses Content-Encoding: gzip requests
+COMPRESS_WEBHOOK = os.environ.get("COMPRESS_WEBHOOK", "false").lower() == "true"
 METADATA_DIR = os.environ.get("METADATA_DIR", "/shared/consultations")
 
+metadata_index = MetadataIndex(METADATA_DIR)
+
+_SESSION = http_utils.create_session(pool_maxsize=16)
+
 def find_consultation_metadata(recording_dir):
     """Find consultation metadata based on recording directory"""
     
     # Extract potential consultation ID from recording directory name
     recording_id = os.path.basename(recording_dir)
     
-    # Look for metadata files
-    metadata_files = []
-    if os.path.exists(METADATA_DIR):
-        for filename in os.listdir(METADATA_DIR):
-            if filename.endswith('_metadata.json'):
-                filepath = os.path.join(METADATA_DIR, filename)
-                try:
-                    with open(filepath, 'r') as f:
-                        metadata = json.load(f)
-                        
-                    # Match by consultation ID or recording pattern
-                    consultation_id = metadata.get('consultation_id', '')
-                    if (consultation_id in recording_id or 
-                        recording_id in consultation_id or
-                        consultation_id == recording_id):
-                        return metadata, filepath
-                        
-                    metadata_files.append((metadata, filepath))
-                        
-                except Exception as e:
-                    print(f"[⚠️] Error reading metadata {filename}: {e}")
+    # Match by consultation ID or recording pattern (only the matching metadata file is opened)
+    metadata, filepath = metadata_index.find(recording_id)
+    if metadata:
+        return metadata, filepath
     
     # If no exact match, try to find the most recent unprocessed consultation
-    if metadata_files:
+    if metadata_index.entries():
         print(f"[🔍] No exact match for {recording_id}, looking for recent unprocessed consultation")
         
-        # Sort by webhook received time and find unprocessed
-        unprocessed = [
-            (meta, path) for meta, path in metadata_files 
-            if not meta.get('recording_processed', False)
-        ]
-        
-        if unprocessed:
-            # Sort by webhook received time (most recent first)
-            unprocessed.sort(key=lambda x: x[0].get('webhook_received', ''), reverse=True)
-            print(f"[📋] Using most recent unprocessed consultation: {unprocessed[0][0].get('consultation_id')}")
-            return unprocessed[0]
+        metadata, filepath = metadata_index.most_recent_unprocessed()
+        if metadata:
+            print(f"[📋] Using most recent unprocessed consultation: {metadata.get('consultation_id')}")
+            return metadata, filepath
     
     print(f"[⚠️] No consultation metadata found for recording {recording_id}")
     return None, None
@@ -92,7 +76,12 @@ def send_to_telesalud_webhook(note_file, metadata):
     print(f"[🌐] Sending to telesalud webhook: {TELESALUD_WEBHOOK_URL}")
     print(f"[🔑] Consultation ID: {consultation_id}")
     
-    response = requests.post(TELESALUD_WEBHOOK_URL, json=webhook_data, headers=headers, timeout=30)
+    body = json_utils.dumps(webhook_data)
+    if COMPRESS_WEBHOOK:
+        body = gzip.compress(body, compresslevel=6)
+        headers['Content-Encoding'] = 'gzip'
+    
+    response = _SESSION.post(TELESALUD_WEBHOOK_URL, data=body, headers=headers, timeout=30)
     return response
 
 def send_to_telesalud_form(note_file, metadata):
@@ -115,7 +104,7 @@ def send_to_telesalud_form(note_file, metadata):
     print(f"[🌐] Sending to telesalud form API: {TELESALUD_API_URL}")
     print(f"[🔑] Consultation ID: {consultation_id}")
     
-    response = requests.post(TELESALUD_API_URL, data=api_data, timeout=30)
+    response = _SESSION.post(TELESALUD_API_URL, data=api_data, timeout=30)
     return response
 
 def send_to_telesalud(note_file):
@@ -157,18 +146,17 @@ def send_to_telesalud(note_file):
             metadata['evolution_sent'] = datetime.now().isoformat()
             metadata['evolution_response'] = response.text
             
-            with open(metadata_file, 'w') as f:
-                json.dump(metadata, f, indent=2)
+            json_utils.dump_atomic(metadata, metadata_file)
+            metadata_index.put(consultation_id, metadata_file, metadata)
             
             # Save confirmation
             confirmation_file = os.path.join(recording_dir, "telesalud_upload.json")
-            with open(confirmation_file, 'w') as f:
-                json.dump({
-                    "status": "success",
-                    "consultation_id": consultation_id,
-                    "timestamp": datetime.now().isoformat(),
-                    "response": response.text
-                }, f, indent=2)
+            json_utils.dump({
+                "status": "success",
+                "consultation_id": consultation_id,
+                "timestamp": datetime.now().isoformat(),
+                "response": response.text
+            }, confirmation_file)
             
             return True
             
@@ -178,14 +166,13 @@ def send_to_telesalud(note_file):
             
             # Save error details
             error_file = os.path.join(recording_dir, "telesalud_error.json")
-            with open(error_file, 'w') as f:
-                json.dump({
-                    "status": "error",
-                    "status_code": response.status_code,
-                    "error": response.text,
-                    "consultation_id": consultation_id,
-                    "timestamp": datetime.now().isoformat()
-                }, f, indent=2)
+            json_utils.dump({
+                "status": "error",
+                "status_code": response.status_code,
+                "error": response.text,
+                "consultation_id": consultation_id,
+                "timestamp": datetime.now().isoformat()
+            }, error_file)
             
             return False
             
@@ -194,13 +181,12 @@ def send_to_telesalud(note_file):
         
         # Save error details
         error_file = os.path.join(recording_dir, "telesalud_error.json")
-        with open(error_file, 'w') as f:
-            json.dump({
-                "status": "error",
-                "error": str(e),
-                "consultation_id": consultation_id,
-                "timestamp": datetime.now().isoformat()
-            }, f, indent=2)
+        json_utils.dump({
+            "status": "error",
+            "error": str(e),
+            "consultation_id": consultation_id,
+            "timestamp": datetime.now().isoformat()
+        }, error_file)
         
         return False
 
@@ -232,7 +218,7 @@ if __name__ == "__main__":
         
         info = get_consultation_info(path)
         if info:
-            print(json.dumps(info, indent=2))
+            print(json_utils.dumps(info, indent=True).decode())
         else:
             print("No consultation metadata found")
     else:
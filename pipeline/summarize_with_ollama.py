@@ -1,15 +1,69 @@
 #!/usr/bin/env python3
 import sys
-import json
 import os
-import requests
+import functools
+import hashlib
+import re
+import ijson
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import http_utils
+import json_utils
+from metadata_index import MetadataIndex
 
 OLLAMA_API_URL = os.environ.get("OLLAMA_API_URL", "http://ollama:11434/api/generate")
 OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL", "llama3.2:3b")
 PROMPTS_DIR = os.environ.get("PROMPTS_DIR", "/pipeline/prompts")
 DEFAULT_PROMPT_TYPE = os.environ.get("DEFAULT_PROMPT_TYPE", "default")
 
+# Multi-stage prompts make several Ollama calls per note; reuse one connection
+_SESSION = http_utils.create_session(pool_maxsize=16)
+# (connect, read) timeout; with streaming the read timeout applies between tokens, not to the whole generation
+OLLAMA_TIMEOUT = (3.05, float(os.environ.get("OLLAMA_READ_TIMEOUT", 120)))
+# Independent stages sent to Ollama at once; match the server's OLLAMA_NUM_PARALLEL
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", 4))
+# How long Ollama keeps the model (and its prompt cache) loaded after a request
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+# Prompt tokens processed per forward pass during prefill; unset keeps the Ollama/model default
+OLLAMA_NUM_BATCH = os.environ.get("OLLAMA_NUM_BATCH")
+# Reuse stage generations for byte-identical prompts (e.g. the same consultation summarized again by
+# the webhook and Jitsi triggers). Exact matches only: near-identical clinical prompts must not share output
+OLLAMA_CACHE = os.environ.get("OLLAMA_CACHE", "false").lower() == "true"
+OLLAMA_CACHE_DIR = os.environ.get("OLLAMA_CACHE_DIR",
+                                  os.path.join(os.environ.get("METADATA_DIR", "/shared/consultations"), "llm_cache"))
+
+
+# Placeholders filled into prompt templates; any other braces are left as written
+TEMPLATE_FIELDS = ('medic_name', 'patient_name', 'conversation_text', 'doctor_notes', 'previous_stage')
+_FIELD_PATTERN = re.compile(r'\{(' + '|'.join(TEMPLATE_FIELDS) + r')\}')
+
+
+@functools.lru_cache(maxsize=64)
+def compile_template(template):
+    """Split a template once into literal text (even positions) and field names (odd positions)"""
+    return tuple(_FIELD_PATTERN.split(template))
+
+
+def render_template(template, **values):
+    """Fill a template's placeholders; fields without a value are kept as written"""
+    parts = compile_template(template)
+    return "".join(
+        values.get(part, f"{{{part}}}") if i % 2 else part
+        for i, part in enumerate(parts)
+    )
+
+
+@functools.lru_cache(maxsize=64)
+def _read_template(path, mtime_ns):
+    """Read a prompt file; mtime_ns in the key drops stale entries after an edit"""
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def read_template(prompt_file):
+    """Read a prompt file, reusing the cached text while the file is unchanged"""
+    return _read_template(str(prompt_file), os.stat(prompt_file).st_mtime_ns)
+
 
 def load_prompt_template(prompt_type=None):
     """Load prompt template from file based on specialty/type"""
@@ -23,8 +77,7 @@ def load_prompt_template(prompt_type=None):
         prompt_file = Path(PROMPTS_DIR) / "default.txt"
     
     if prompt_file.exists():
-        with open(prompt_file, 'r') as f:
-            template = f.read()
+        template = read_template(prompt_file)
         print(f"[📝] Using prompt template: {prompt_file.name}")
         return template
     else:
@@ -32,6 +85,10 @@ def load_prompt_template(prompt_type=None):
         return None
 
 
+# First line of a stage file that should be sent without the directory's context.txt
+NO_CONTEXT_MARKER = "{no_context}"
+
+
 def load_multi_stage_prompts(prompt_type):
     """Load multi-stage prompts from a subdirectory (e.g., prompts/autism/)"""
     prompt_dir = Path(PROMPTS_DIR) / prompt_type
@@ -47,30 +104,93 @@ def load_multi_stage_prompts(prompt_type):
     
     stages = []
     for pf in prompt_files:
-        with open(pf, 'r') as f:
-            stages.append({
-                'name': pf.stem,  # e.g., "1-history"
-                'template': f.read()
-            })
+        template = read_template(pf)
+        use_context = not template.startswith(NO_CONTEXT_MARKER)
+        stages.append({
+            'name': pf.stem,  # e.g., "1-history"
+            'template': template if use_context else template[len(NO_CONTEXT_MARKER):].lstrip('\n'),
+            'use_context': use_context
+        })
     
     print(f"[📝] Loaded {len(stages)} stage prompts from {prompt_type}/")
     return stages
 
 
-def call_ollama(prompt, temperature=0.3):
+def load_stage_context(prompt_type):
+    """Load the shared context (e.g., prompts/autism/context.txt) prepended to every stage prompt, if any"""
+    context_file = Path(PROMPTS_DIR) / prompt_type / "context.txt"
+    
+    if not context_file.exists():
+        return None
+    
+    return read_template(context_file)
+
+
+def post_ollama(prompt, temperature=0.3, max_tokens=2000):
+    """Start a streaming generate request; Ollama replies with one JSON object per line"""
+    # Sampling parameters are only honoured under "options"
+    options = {
+        "temperature": temperature,
+        "num_predict": max_tokens
+    }
+    if OLLAMA_NUM_BATCH:
+        options["num_batch"] = int(OLLAMA_NUM_BATCH)
+    
+    return _SESSION.post(OLLAMA_API_URL, json={
+        "model": OLLAMA_MODEL,
+        "prompt": prompt,
+        "stream": True,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": options
+    }, stream=True, timeout=OLLAMA_TIMEOUT)
+
+
+def ollama_tokens(response):
+    """Yield generated text from a streaming Ollama response as it arrives"""
+    for line in response.iter_lines():
+        if not line:
+            continue
+        chunk = json_utils.loads(line)
+        if chunk.get('error'):
+            raise RuntimeError(f"Ollama error: {chunk['error']}")
+        yield chunk.get('response', '')
+
+
+def prompt_cache_file(prompt, temperature, max_tokens):
+    """Cache file for a generation, keyed by everything that shapes the output"""
+    key = hashlib.sha256(json_utils.dumps([OLLAMA_MODEL, temperature, max_tokens, prompt])).hexdigest()
+    return os.path.join(OLLAMA_CACHE_DIR, f"{key}.json")
+
+
+def store_cached_generation(cache_file, result):
+    """Save a generation to the cache; failing to cache never loses the result"""
+    try:
+        os.makedirs(OLLAMA_CACHE_DIR, exist_ok=True)
+        json_utils.dump_atomic({'model': OLLAMA_MODEL, 'response': result}, cache_file, indent=False)
+    except OSError as e:
+        print(f"[⚠️] Could not cache generation in {OLLAMA_CACHE_DIR}: {e}")
+
+
+def call_ollama(prompt, temperature=0.3, max_tokens=2000):
     """Make a single call to Ollama API"""
+    cache_file = prompt_cache_file(prompt, temperature, max_tokens) if OLLAMA_CACHE else None
+    if cache_file:
+        try:
+            cached = json_utils.load(cache_file)['response']
+            print(f"[♻️] Reusing cached generation for identical prompt")
+            return cached
+        except (OSError, KeyError, json_utils.JSONDecodeError):
+            # Missing, unreadable or corrupt cache entries are just a miss
+            pass
+    
     try:
-        response = requests.post(OLLAMA_API_URL, json={
-            "model": OLLAMA_MODEL,
-            "prompt": prompt,
-            "stream": False,
-            "temperature": temperature,
-            "max_tokens": 2000
-        }, timeout=120)
+        response = post_ollama(prompt, temperature, max_tokens)
         
         if response.status_code == 200:
-            result = response.json()
-            return result.get('response', '')
+            result = "".join(ollama_tokens(response))
+            if cache_file and result:
+                store_cached_generation(cache_file, result)
+            return result
         else:
             print(f"[❌] Ollama API error: {response.status_code}")
             return None
@@ -79,66 +199,115 @@ def call_ollama(prompt, temperature=0.3):
         return None
 
 
-def run_multi_stage_pipeline(stages, conversation_text, doctor_notes, medic_name, patient_name):
+def stage_levels(stages):
+    """
+    Group stage indexes into levels whose stages can run concurrently
+    A stage that uses {previous_stage} needs every earlier stage, so it starts a new level
+    """
+    levels = []
+    for i, stage in enumerate(stages):
+        if not levels or '{previous_stage}' in stage['template']:
+            levels.append([])
+        levels[-1].append(i)
+    return levels
+
+
+def run_multi_stage_pipeline(stages, conversation_text, doctor_notes, medic_name, patient_name, context_template=None):
     """Run multi-stage prompt pipeline, each stage building on previous"""
-    results = []
-    previous_stage = ""
+    results = [None] * len(stages)
+    variables = {
+        'medic_name': medic_name,
+        'patient_name': patient_name,
+        'conversation_text': conversation_text,
+        'doctor_notes': doctor_notes if doctor_notes else "No template notes provided."
+    }
+    # Every stage prompt starts with the same context (usually the transcript), so Ollama
+    # reuses the cached prefix instead of re-reading the transcript for each stage
+    context = render_template(context_template, **variables) if context_template else ""
+    # Completed stage outputs, joined once per prompt instead of re-concatenated after every stage
+    completed = []
     
-    for i, stage in enumerate(stages):
-        print(f"[🔄] Running stage {i+1}/{len(stages)}: {stage['name']}")
-        
-        # Build prompt with all variables
-        prompt = stage['template'].format(
-            medic_name=medic_name,
-            patient_name=patient_name,
-            conversation_text=conversation_text,
-            doctor_notes=doctor_notes if doctor_notes else "No template notes provided.",
-            previous_stage=previous_stage if previous_stage else "No previous stage information."
-        )
-        
-        result = call_ollama(prompt)
-        
-        if result:
-            results.append({
-                'stage': stage['name'],
-                'content': result
-            })
-            # Accumulate for next stage
-            previous_stage = previous_stage + "\n\n" + result if previous_stage else result
-            print(f"[✅] Stage {stage['name']} completed")
-        else:
-            print(f"[⚠️] Stage {stage['name']} failed, continuing...")
-            results.append({
-                'stage': stage['name'],
-                'content': f"[Stage {stage['name']} processing failed]"
-            })
+    with ThreadPoolExecutor(max_workers=max(1, OLLAMA_NUM_PARALLEL)) as executor:
+        for level in stage_levels(stages):
+            previous_stage = "\n\n".join(completed) if completed else "No previous stage information."
+            
+            prompts = []
+            for i in level:
+                stage = stages[i]
+                print(f"[🔄] Running stage {i+1}/{len(stages)}: {stage['name']}")
+                
+                # Build prompt with all variables
+                prompts.append(
+                    (context if stage.get('use_context', True) else "")
+                    + render_template(stage['template'], **variables, previous_stage=previous_stage)
+                )
+            
+            # Stages in a level don't depend on each other; results come back in stage order
+            for i, result in zip(level, executor.map(call_ollama, prompts)):
+                stage = stages[i]
+                if result:
+                    results[i] = {
+                        'stage': stage['name'],
+                        'content': result
+                    }
+                    # Accumulate for next stage
+                    completed.append(result)
+                    print(f"[✅] Stage {stage['name']} completed")
+                else:
+                    print(f"[⚠️] Stage {stage['name']} failed, continuing...")
+                    results[i] = {
+                        'stage': stage['name'],
+                        'content': f"[Stage {stage['name']} processing failed]"
+                    }
     
     return results
 
 
+def write_final_note(recording_dir, parts):
+    """Compose final_note.txt in memory and atomically replace any earlier note; returns its path"""
+    text_output = os.path.join(recording_dir, "final_note.txt")
+    json_utils.atomic_write_bytes(text_output, "".join(parts).encode('utf-8'))
+    return text_output
+
+
 def load_consultation_metadata(transcript_file):
     """Load consultation metadata including doctor notes"""
     recording_dir = os.path.dirname(transcript_file)
     recording_id = os.path.basename(recording_dir)
     
-    # Look for metadata file
+    # Look up the metadata file in the index instead of opening every one
     metadata_dir = os.environ.get("METADATA_DIR", "/shared/consultations")
-    if os.path.exists(metadata_dir):
-        for filename in os.listdir(metadata_dir):
-            if filename.endswith('_metadata.json'):
-                filepath = os.path.join(metadata_dir, filename)
-                try:
-                    with open(filepath, 'r') as f:
-                        metadata = json.load(f)
-                    
-                    consultation_id = metadata.get('consultation_id', '')
-                    if (consultation_id in recording_id or 
-                        recording_id in consultation_id):
-                        return metadata
-                except Exception as e:
-                    print(f"[⚠️] Error reading metadata {filename}: {e}")
+    metadata, _ = MetadataIndex(metadata_dir).find(recording_id)
+    return metadata
+
+def load_transcript(transcript_file):
+    """
+    Stream the merged transcript in one pass instead of loading the whole document
+    Returns (transcript_data, conversation_text); transcript_data holds recording_id and speaker/segment counts
+    """
+    transcript_data = {'recording_id': None, 'total_speakers': 0, 'total_segments': 0}
+    parts = []
+    speaker, text = 'Unknown', ''
+    
+    # Accept final_merged.json.gz when the merge step wrote a compressed copy
+    with json_utils.open_binary(json_utils.existing(transcript_file)) as f:
+        for prefix, event, value in ijson.parse(f, use_float=True):
+            if prefix == 'full_transcript.item':
+                if event == 'start_map':
+                    speaker, text = 'Unknown', ''
+                elif event == 'end_map':
+                    parts.append(f"{speaker}: {text}\n")
+                    transcript_data['total_segments'] += 1
+            elif prefix == 'full_transcript.item.speaker':
+                speaker = value
+            elif prefix == 'full_transcript.item.text':
+                text = value
+            elif prefix == 'speakers.item' and event == 'start_map':
+                transcript_data['total_speakers'] += 1
+            elif prefix == 'recording_id':
+                transcript_data['recording_id'] = value
     
-    return None
+    return transcript_data, "".join(parts)
 
 def summarize_with_ollama(transcript_file):
     """Generate clinical summary using Ollama LLM"""
@@ -146,8 +315,7 @@ def summarize_with_ollama(transcript_file):
     print(f"[🤖 LLM] Generating summary from {transcript_file}")
     
     # Load transcript
-    with open(transcript_file, 'r') as f:
-        transcript_data = json.load(f)
+    transcript_data, conversation_text = load_transcript(transcript_file)
     
     # Load consultation metadata for doctor notes
     metadata = load_consultation_metadata(transcript_file)
@@ -163,13 +331,6 @@ def summarize_with_ollama(transcript_file):
         if doctor_notes:
             print(f"[📝] Including doctor's typed notes in summary")
     
-    # Prepare conversation text
-    conversation_text = ""
-    for entry in transcript_data.get('full_transcript', []):
-        speaker = entry.get('speaker', 'Unknown')
-        text = entry.get('text', '')
-        conversation_text += f"{speaker}: {text}\n"
-    
     # Get prompt type from metadata (e.g., specialty) or use default
     prompt_type = None
     if metadata:
@@ -187,7 +348,8 @@ def summarize_with_ollama(transcript_file):
             conversation_text, 
             doctor_notes, 
             medic_name, 
-            patient_name
+            patient_name,
+            load_stage_context(prompt_type)
         )
         
         # Combine all stages into final note
@@ -210,8 +372,8 @@ def summarize_with_ollama(transcript_file):
             "stages": stage_results,
             "summary": summary,
             "metadata": {
-                "total_speakers": len(transcript_data.get('speakers', [])),
-                "total_segments": len(transcript_data.get('full_transcript', [])),
+                "total_speakers": transcript_data['total_speakers'],
+                "total_segments": transcript_data['total_segments'],
                 "patient_name": patient_name,
                 "medic_name": medic_name,
                 "doctor_notes_included": bool(doctor_notes),
@@ -219,22 +381,20 @@ def summarize_with_ollama(transcript_file):
             }
         }
         
-        json_output = os.path.join(recording_dir, "clinical_summary.json")
-        with open(json_output, 'w') as f:
-            json.dump(summary_data, f, indent=2)
+        json_utils.dump_output(summary_data, os.path.join(recording_dir, "clinical_summary.json"))
         
         # Save as text
-        text_output = os.path.join(recording_dir, "final_note.txt")
-        with open(text_output, 'w') as f:
-            f.write(f"Telehealth Consultation - {prompt_type.title()} Evaluation\n")
-            f.write(f"Patient: {patient_name}\n")
-            f.write(f"Provider: {medic_name}\n")
-            f.write(f"Recording ID: {transcript_data.get('recording_id')}\n")
-            f.write("=" * 60 + "\n\n")
-            f.write(summary)
-            f.write("\n\n" + "=" * 60 + "\n")
-            f.write(f"Generated by: {OLLAMA_MODEL} (multi-stage pipeline)\n")
-            f.write(f"Stages completed: {len(stage_results)}\n")
+        text_output = write_final_note(recording_dir, [
+            f"Telehealth Consultation - {prompt_type.title()} Evaluation\n",
+            f"Patient: {patient_name}\n",
+            f"Provider: {medic_name}\n",
+            f"Recording ID: {transcript_data.get('recording_id')}\n",
+            "=" * 60 + "\n\n",
+            summary,
+            "\n\n" + "=" * 60 + "\n",
+            f"Generated by: {OLLAMA_MODEL} (multi-stage pipeline)\n",
+            f"Stages completed: {len(stage_results)}\n"
+        ])
         
         print(f"[✅] Saved multi-stage summary to {text_output}")
         return
@@ -244,7 +404,8 @@ def summarize_with_ollama(transcript_file):
     
     # Build prompt from template or use hardcoded default
     if template:
-        prompt = template.format(
+        prompt = render_template(
+            template,
             medic_name=medic_name,
             patient_name=patient_name,
             conversation_text=conversation_text,
@@ -276,29 +437,39 @@ Clinical Summary:"""
     
     # Call Ollama API
     try:
-        response = requests.post(OLLAMA_API_URL, json={
-            "model": OLLAMA_MODEL,
-            "prompt": prompt,
-            "stream": False,
-            "temperature": 0.3,  # Lower temperature for more consistent output
-            "max_tokens": 1000
-        })
+        # Lower temperature for more consistent output
+        response = post_ollama(prompt, temperature=0.3, max_tokens=1000)
         
         if response.status_code == 200:
-            result = response.json()
-            summary = result.get('response', '')
-            
             # Save summary
             recording_dir = os.path.dirname(transcript_file)
             
+            # Collect the streamed generation; the note is only written once it is complete,
+            # so a failed or timed-out call never leaves a partial final_note.txt behind
+            summary = "".join(ollama_tokens(response))
+            
+            # Save as text
+            sources = "Audio transcript + Doctor's typed notes" if doctor_notes else "Audio transcript only"
+            text_output = write_final_note(recording_dir, [
+                "Telehealth Consultation Summary\n",
+                f"Patient: {patient_name}\n",
+                f"Provider: {medic_name}\n",
+                f"Recording ID: {transcript_data.get('recording_id')}\n",
+                "=" * 50 + "\n\n",
+                summary,
+                "\n\n" + "=" * 50 + "\n",
+                f"Generated by: {OLLAMA_MODEL}\n",
+                f"Sources: {sources}\n"
+            ])
+            
             # Save as JSON
             summary_data = {
                 "recording_id": transcript_data.get('recording_id'),
                 "model": OLLAMA_MODEL,
                 "summary": summary,
                 "metadata": {
-                    "total_speakers": len(transcript_data.get('speakers', [])),
-                    "total_segments": len(transcript_data.get('full_transcript', [])),
+                    "total_speakers": transcript_data['total_speakers'],
+                    "total_segments": transcript_data['total_segments'],
                     "patient_name": patient_name,
                     "medic_name": medic_name,
                     "doctor_notes_included": bool(doctor_notes),
@@ -306,25 +477,7 @@ Clinical Summary:"""
                 }
             }
             
-            json_output = os.path.join(recording_dir, "clinical_summary.json")
-            with open(json_output, 'w') as f:
-                json.dump(summary_data, f, indent=2)
-            
-            # Save as text
-            text_output = os.path.join(recording_dir, "final_note.txt")
-            with open(text_output, 'w') as f:
-                f.write(f"Telehealth Consultation Summary\n")
-                f.write(f"Patient: {patient_name}\n")
-                f.write(f"Provider: {medic_name}\n")
-                f.write(f"Recording ID: {transcript_data.get('recording_id')}\n")
-                f.write("=" * 50 + "\n\n")
-                f.write(summary)
-                f.write("\n\n" + "=" * 50 + "\n")
-                f.write(f"Generated by: {OLLAMA_MODEL}\n")
-                if doctor_notes:
-                    f.write("Sources: Audio transcript + Doctor's typed notes\n")
-                else:
-                    f.write("Sources: Audio transcript only\n")
+            json_utils.dump_output(summary_data, os.path.join(recording_dir, "clinical_summary.json"))
             
             print(f"[✅] Saved summary to {text_output}")
             
@@ -337,14 +490,13 @@ Clinical Summary:"""
         
         # Fallback: Create a basic summary
         recording_dir = os.path.dirname(transcript_file)
-        text_output = os.path.join(recording_dir, "final_note.txt")
-        
-        with open(text_output, 'w') as f:
-            f.write(f"Telehealth Consultation Transcript\n")
-            f.write(f"Recording ID: {transcript_data.get('recording_id')}\n")
-            f.write("=" * 50 + "\n\n")
-            f.write("Note: Automated summary generation failed. Full transcript below:\n\n")
-            f.write(conversation_text)
+        text_output = write_final_note(recording_dir, [
+            "Telehealth Consultation Transcript\n",
+            f"Recording ID: {transcript_data.get('recording_id')}\n",
+            "=" * 50 + "\n\n",
+            "Note: Automated summary generation failed. Full transcript below:\n\n",
+            conversation_text
+        ])
         
         print(f"[⚠️] Saved transcript without summary to {text_output}")
 
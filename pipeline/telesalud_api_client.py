@@ -4,9 +4,13 @@ Secure API client for retrieving consultation data from telesalud
 Uses proper authentication and only requests data when needed
 """
 import os
-import requests
-import json
 from datetime import datetime
+import http_utils
+import json_utils
+from metadata_index import MetadataIndex
+
+# Shared by every client instance so repeated lookups reuse the keep-alive connection
+_SESSION = http_utils.create_session()
 
 class TelesaludAPIClient:
     def __init__(self):
@@ -20,6 +24,8 @@ class TelesaludAPIClient:
         if self.api_token:
             self.headers["Authorization"] = f"Bearer {self.api_token}"
         
+        self.session = _SESSION
+        
     def get_consultation_data(self, consultation_id):
         """
         Securely retrieve full consultation data via authenticated API
@@ -36,10 +42,10 @@ class TelesaludAPIClient:
             
             print(f"[🔐 API] Requesting consultation data for {consultation_id}")
             
-            response = requests.get(url, params=params, headers=self.headers, timeout=30)
+            response = self.session.get(url, params=params, headers=self.headers, timeout=30)
             
             if response.status_code == 200:
-                data = response.json()
+                data = json_utils.loads(response.content)
                 print(f"[✅ API] Successfully retrieved consultation data")
                 return data
                 
@@ -110,8 +116,8 @@ class TelesaludAPIClient:
         filename = f"{consultation_id}_metadata.json"
         filepath = os.path.join(metadata_dir, filename)
         
-        with open(filepath, 'w') as f:
-            json.dump(metadata, f, indent=2)
+        json_utils.dump_atomic(metadata, filepath)
+        MetadataIndex(metadata_dir).put(consultation_id, filepath, metadata)
         
         print(f"[💾] Saved consultation metadata to {filepath}")
 
@@ -152,7 +158,7 @@ if __name__ == "__main__":
     metadata = get_consultation_data_securely(consultation_id)
     
     if metadata:
-        print(json.dumps(metadata, indent=2))
+        print(json_utils.dumps(metadata, indent=True).decode())
     else:
         print("Failed to retrieve consultation data")
         sys.exit(1)
\ No newline at end of file
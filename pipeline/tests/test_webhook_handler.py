@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Tests for the telesalud webhook payload handling in webhook_handler.py
+"""
+import os
+import sys
+
+import pytest
+from fastapi.testclient import TestClient
+
+# Pipeline scripts import their siblings directly
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json_utils
+import webhook_handler
+from metadata_index import MetadataIndex
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """Webhook app writing metadata to a temporary directory (lifespan not run, so no rooms database)"""
+    metadata_dir = str(tmp_path)
+    monkeypatch.setattr(webhook_handler, 'METADATA_DIR', metadata_dir)
+    monkeypatch.setattr(webhook_handler, 'metadata_index', MetadataIndex(metadata_dir))
+    monkeypatch.setattr(webhook_handler, '_metadata_dir_ready', False)
+    monkeypatch.setattr(webhook_handler, 'WEBHOOK_TOKEN', '')
+    return TestClient(webhook_handler.app)
+
+
+@pytest.fixture
+def rooms_app(tmp_path, monkeypatch):
+    """Webhook app with the rooms database in a temporary directory; enter TestClient(app) to run lifespan"""
+    monkeypatch.setattr(webhook_handler, 'ROOMS_DB', str(tmp_path / 'rooms.db'))
+    monkeypatch.setattr(webhook_handler, 'METADATA_DIR', str(tmp_path))
+    monkeypatch.setattr(webhook_handler, 'RECORDINGS_PATH', tmp_path / 'recordings')
+    monkeypatch.setattr(webhook_handler, 'active_rooms', {})
+    return webhook_handler.app
+
+
+def test_numeric_consultation_id_is_accepted(client, tmp_path):
+    response = client.post('/webhook/telesalud', json={
+        'event': 'consultation_started',
+        'data': {'consultation_id': 12345, 'patient_name': 'Test Patient'}
+    })
+
+    assert response.status_code == 200
+    metadata = json_utils.load(tmp_path / '12345_metadata.json')
+    assert metadata['consultation_id'] == '12345'
+    assert metadata['patient_name'] == 'Test Patient'
+
+
+def test_numeric_secret_in_legacy_payload_is_accepted(client, tmp_path):
+    response = client.post('/webhook/telesalud', json={
+        'topic': 'videoconsultation-started',
+        'vc': {'secret': 678, 'status': 1}
+    })
+
+    assert response.status_code == 200
+    assert json_utils.load(tmp_path / '678_metadata.json')['consultation_id'] == '678'
+
+
+def test_null_vc_is_treated_as_empty(client, tmp_path):
+    response = client.post('/webhook/telesalud', json={'topic': 'videoconsultation-started', 'vc': None})
+
+    assert response.status_code == 200
+    assert not list(tmp_path.glob('*_metadata.json'))
+
+
+def test_numeric_string_fields_are_accepted(client, tmp_path):
+    response = client.post('/webhook/telesalud', json={
+        'event': 'consultation_started',
+        'data': {'consultation_id': 'c1', 'specialty': 42, 'prompt_type': 7, 'patient_name': 12.5, 'doctor_notes': 3}
+    })
+
+    assert response.status_code == 200
+    metadata = json_utils.load(tmp_path / 'c1_metadata.json')
+    assert metadata['specialty'] == '42'
+    assert metadata['prompt_type'] == '7'
+    assert metadata['patient_name'] == '12.5'
+    assert metadata['doctor_notes'] == '3'
+
+
+def test_null_topic_is_treated_as_missing(client):
+    response = client.post('/webhook/telesalud', json={'topic': None, 'vc': {'secret': 'abc'}})
+
+    assert response.status_code == 200
+    assert webhook_handler.TelesaludWebhook.model_validate({'topic': None}).topic == ''
+
+
+def test_recreated_room_does_not_restore_previous_occupants(rooms_app):
+    with TestClient(rooms_app) as client:
+        client.post('/events/room/created', json={'room_name': 'room1', 'created_at': 1})
+        client.post('/events/occupant/joined', json={
+            'room_name': 'room1', 'occupant': {'occupant_jid': 'a@example.com', 'name': 'A'}
+        })
+        client.post('/events/room/created', json={'room_name': 'room1', 'created_at': 2})
+        assert client.get('/events/rooms').json()['room1']['occupants'] == []
+
+    # Simulate a restart: rooms are reloaded from the database only
+    webhook_handler.active_rooms.clear()
+    with TestClient(rooms_app) as client:
+        room = client.get('/events/rooms').json()['room1']
+
+    assert room['created_at'] == 2
+    assert room['occupants'] == []
+
+
+def test_null_is_breakout_is_treated_as_false(rooms_app):
+    with TestClient(rooms_app) as client:
+        response = client.post('/events/room/created', json={'room_name': 'room1', 'is_breakout': None})
+        room = client.get('/events/rooms').json()['room1']
+
+    assert response.status_code == 200
+    assert room['is_breakout'] is False
+
+
+def test_null_all_occupants_is_treated_as_empty(rooms_app):
+    with TestClient(rooms_app) as client:
+        client.post('/events/room/created', json={'room_name': 'room1'})
+        response = client.post('/events/room/destroyed', json={'room_name': 'room1', 'all_occupants': None})
+        rooms = client.get('/events/rooms').json()
+
+    assert response.status_code == 200
+    assert 'room1' not in rooms
@@ -3,84 +3,234 @@
 Webhook handler for receiving telesalud consultation notifications
 Listens for videoconsultation events and stores metadata for pipeline processing
 """
-import json
+import asyncio
+import hmac
 import os
-import subprocess
+import signal
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime
-from flask import Flask, request, jsonify
+from pathlib import Path
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator
+import uvicorn
 import threading
 import time
-
-app = Flask(__name__)
+import json_utils
+from metadata_index import MetadataIndex
+
+class FastJSONResponse(JSONResponse):
+    """JSON response rendered with json_utils (orjson when installed)"""
+    def render(self, content):
+        return json_utils.dumps(content)
+
+@asynccontextmanager
+async def lifespan(app):
+    """Restore room state, start the speaker mapping flusher and write pending mappings on shutdown"""
+    await run_rooms_db(open_rooms_db)
+    flusher = threading.Thread(target=speaker_mapping_flusher, daemon=True)
+    flusher.start()
+    yield
+    await asyncio.to_thread(flush_speaker_mappings)
+    await run_rooms_db(_rooms_db.close)
+
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
 
 # Directory to store consultation metadata
 METADATA_DIR = os.environ.get("METADATA_DIR", "/shared/consultations")
 WEBHOOK_TOKEN = os.environ.get("WEBHOOK_TOKEN", "")
+WEBHOOK_TOKEN_BYTES = WEBHOOK_TOKEN.encode()
+# Legacy-format topics worth recording; others are acknowledged without touching disk
+WEBHOOK_TOPICS = frozenset(
+    topic.strip() for topic in
+    os.environ.get("WEBHOOK_TOPICS", "videoconsultation-started,videoconsultation-finished").split(",")
+    if topic.strip()
+)
+
+metadata_index = MetadataIndex(METADATA_DIR)
+
+_metadata_dir_ready = False
 
 def ensure_metadata_dir():
-    """Ensure metadata directory exists"""
-    os.makedirs(METADATA_DIR, exist_ok=True)
+    """Ensure metadata directory exists (created once per process, not per request)"""
+    global _metadata_dir_ready
+    if not _metadata_dir_ready:
+        os.makedirs(METADATA_DIR, exist_ok=True)
+        _metadata_dir_ready = True
+
+# Pipeline runs in flight, by consultation; the event loop only keeps weak references to tasks
+_pipeline_tasks = {}
+# Upper bound on finalize_wrapper.sh runs at once when many consultations end together
+PIPELINE_WORKERS = int(os.environ.get('PIPELINE_WORKERS', 4))
+_pipeline_slots = asyncio.Semaphore(PIPELINE_WORKERS)
+# Seconds a finalize run may take before it is killed
+PIPELINE_TIMEOUT = float(os.environ.get('PIPELINE_TIMEOUT', 7200))
+# Seconds the wrapper gets after SIGTERM to run its cleanup trap before its process group is killed
+PIPELINE_KILL_GRACE = float(os.environ.get('PIPELINE_KILL_GRACE', 10))
+
+async def log_pipeline_output(stream, consultation_id):
+    """Print the wrapper's output as it arrives instead of buffering the whole run"""
+    async for line in stream:
+        print(f"[📜 {consultation_id}] {line.decode(errors='replace').rstrip()}")
+
+async def stop_pipeline_process(process):
+    """Stop the wrapper and everything it started, giving its trap time to remove the lock file"""
+    # The wrapper leads its own session, so its pid is also the process group id
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    try:
+        await asyncio.wait_for(process.wait(), timeout=PIPELINE_KILL_GRACE)
+    except asyncio.TimeoutError:
+        pass
+    # Anything left in the group (including children that outlived the wrapper) is killed outright
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    await process.wait()
 
-def trigger_pipeline_async(consultation_id):
-    """Trigger the pipeline processing asynchronously for webhook mode"""
-    def run_pipeline():
+async def run_pipeline(consultation_id):
+    """Run the finalize wrapper for a finished consultation without holding a thread while it waits"""
+    async with _pipeline_slots:
+        await _run_pipeline(consultation_id)
+
+async def _run_pipeline(consultation_id):
+    try:
+        # Wait a moment to ensure recording is fully written
+        await asyncio.sleep(5)
+
+        # Check if already being processed (lock exists)
+        metadata_dir = os.environ.get("METADATA_DIR", "/shared/consultations")
+        lock_file = os.path.join(metadata_dir, f"{consultation_id}.lock")
+
+        if os.path.exists(lock_file):
+            print(f"[🔒] Consultation {consultation_id} already being processed")
+            print(f"[⏭️] Webhook trigger skipped - Jitsi likely already processing")
+            return
+
+        # Determine recording directory (this assumes standard Jitsi naming)
+        recording_dir = f"/recordings/{consultation_id}"
+
+        # Check if recording directory exists
+        if not os.path.exists(recording_dir):
+            print(f"[⚠️] Recording directory not found yet: {recording_dir}")
+            # Could implement retry logic here
+            return
+
+        print(f"[🚀] Triggering pipeline for consultation {consultation_id}")
+
+        # Call the wrapper script with webhook trigger source
+        process = await asyncio.create_subprocess_exec(
+            "/pipeline/finalize_wrapper.sh", recording_dir, "webhook", consultation_id,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            start_new_session=True  # Own process group, so finalize.sh, python and ffmpeg can be stopped with it
+        )
         try:
-            # Wait a moment to ensure recording is fully written
-            time.sleep(5)
-
-            # Check if already being processed (lock exists)
-            metadata_dir = os.environ.get("METADATA_DIR", "/shared/consultations")
-            lock_file = os.path.join(metadata_dir, f"{consultation_id}.lock")
-
-            if os.path.exists(lock_file):
-                print(f"[🔒] Consultation {consultation_id} already being processed")
-                print(f"[⏭️] Webhook trigger skipped - Jitsi likely already processing")
-                return
-
-            # Determine recording directory (this assumes standard Jitsi naming)
-            recording_dir = f"/recordings/{consultation_id}"
-
-            # Check if recording directory exists
-            if not os.path.exists(recording_dir):
-                print(f"[⚠️] Recording directory not found yet: {recording_dir}")
-                # Could implement retry logic here
-                return
-
-            print(f"[🚀] Triggering pipeline for consultation {consultation_id}")
-
-            # Call the wrapper script with webhook trigger source
-            result = subprocess.run(
-                ["/pipeline/finalize_wrapper.sh", recording_dir, "webhook", consultation_id],
-                capture_output=True,
-                text=True
+            await asyncio.wait_for(
+                asyncio.gather(log_pipeline_output(process.stdout, consultation_id), process.wait()),
+                timeout=PIPELINE_TIMEOUT
             )
+        except asyncio.TimeoutError:
+            print(f"[❌] Pipeline timed out after {PIPELINE_TIMEOUT:.0f}s for {consultation_id}")
+            return
+        finally:
+            # Timeout, server shutdown or an error while relaying output: don't leave the pipeline running unsupervised
+            if process.returncode is None:
+                await stop_pipeline_process(process)
+
+        if process.returncode == 0:
+            print(f"[✅] Pipeline completed successfully for {consultation_id}")
+        else:
+            print(f"[❌] Pipeline failed for {consultation_id} (exit code {process.returncode})")
 
-            if result.returncode == 0:
-                print(f"[✅] Pipeline completed successfully for {consultation_id}")
-            else:
-                print(f"[❌] Pipeline failed for {consultation_id}: {result.stderr}")
-
-        except Exception as e:
-            print(f"[❌] Error triggering pipeline: {str(e)}")
+    except Exception as e:
+        print(f"[❌] Error triggering pipeline: {str(e)}")
 
-    # Run in background thread
-    thread = threading.Thread(target=run_pipeline)
-    thread.daemon = True
-    thread.start()
+def trigger_pipeline_async(consultation_id):
+    """Trigger the pipeline processing asynchronously for webhook mode"""
+    # Repeated end events for the same consultation share the run already queued
+    if consultation_id in _pipeline_tasks:
+        print(f"[⏭️] Pipeline already queued for {consultation_id}")
+        return
+    
+    # Runs on the server's event loop; the wait and the subprocess don't need a thread of their own
+    task = asyncio.create_task(run_pipeline(consultation_id))
+    _pipeline_tasks[consultation_id] = task
+    task.add_done_callback(lambda _: _pipeline_tasks.pop(consultation_id, None))
     print(f"[🔄] Pipeline triggered in background for {consultation_id}")
 
+# Telesalud webhook payloads, parsed and validated in one pass like the Prosody events below.
+# Both the legacy 'vc' object and the event-based 'data' object carry consultation fields.
+def number_to_str(value):
+    """Before-validator body: the baseline read these fields with dict.get, so numbers must still be accepted"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    return value
+
+
+class Consultation(BaseModel):
+    model_config = ConfigDict(extra='allow')
+
+    secret: str | None = None
+    consultation_id: str | None = None
+    status: str | int | None = None
+    specialty: str | None = None
+    prompt_type: str | None = None
+    patient_name: str | None = None
+    medic_name: str | None = None
+    doctor_notes: str | None = None
+
+    # Telesalud may send numeric IDs (the metadata filenames and index keys are strings) or numeric codes
+    @field_validator(
+        'secret', 'consultation_id', 'specialty', 'prompt_type', 'patient_name', 'medic_name', 'doctor_notes',
+        mode='before'
+    )
+    @classmethod
+    def fields_to_str(cls, value):
+        return number_to_str(value)
+
+
+class TelesaludWebhook(BaseModel):
+    event: str | None = None
+    data: Consultation = Field(default_factory=Consultation)
+    vc: Consultation = Field(default_factory=Consultation)
+    topic: str = ''
+
+    # An explicit null carries no consultation fields, same as leaving the object out
+    @field_validator('data', 'vc', mode='before')
+    @classmethod
+    def null_to_empty(cls, value):
+        return {} if value is None else value
+
+    @field_validator('event', mode='before')
+    @classmethod
+    def event_to_str(cls, value):
+        return number_to_str(value)
+
+    # A null topic is treated like a missing one
+    @field_validator('topic', mode='before')
+    @classmethod
+    def topic_to_str(cls, value):
+        return '' if value is None else number_to_str(value)
+
+
 def save_event_notification(vc_data, topic):
     """Save event notification with metadata for pipeline processing"""
     ensure_metadata_dir()
     
-    consultation_id = vc_data.get('secret') or vc_data.get('consultation_id')
+    consultation_id = vc_data.secret or vc_data.consultation_id
     if not consultation_id:
         return False
     
     # Build event data
     event_data = {
         'consultation_id': consultation_id,
-        'status': vc_data.get('status'),
+        'status': vc_data.status,
         'topic': topic,
         'webhook_received': datetime.now().isoformat(),
         'patient_data_retrieved': False,
@@ -88,16 +238,16 @@ def save_event_notification(vc_data, topic):
     }
     
     # Include specialty/prompt_type if provided (for AI note generation)
-    if vc_data.get('specialty'):
-        event_data['specialty'] = vc_data.get('specialty')
-    if vc_data.get('prompt_type'):
-        event_data['prompt_type'] = vc_data.get('prompt_type')
-    if vc_data.get('patient_name'):
-        event_data['patient_name'] = vc_data.get('patient_name')
-    if vc_data.get('medic_name'):
-        event_data['medic_name'] = vc_data.get('medic_name')
-    if vc_data.get('doctor_notes'):
-        event_data['doctor_notes'] = vc_data.get('doctor_notes')
+    if vc_data.specialty:
+        event_data['specialty'] = vc_data.specialty
+    if vc_data.prompt_type:
+        event_data['prompt_type'] = vc_data.prompt_type
+    if vc_data.patient_name:
+        event_data['patient_name'] = vc_data.patient_name
+    if vc_data.medic_name:
+        event_data['medic_name'] = vc_data.medic_name
+    if vc_data.doctor_notes:
+        event_data['doctor_notes'] = vc_data.doctor_notes
     
     # Save to file (use _metadata.json suffix for pipeline compatibility)
     filename = f"{consultation_id}_metadata.json"
@@ -106,67 +256,70 @@ def save_event_notification(vc_data, topic):
     # Merge with existing metadata if present
     if os.path.exists(filepath):
         try:
-            with open(filepath, 'r') as f:
-                existing = json.load(f)
+            existing = json_utils.load(filepath)
             existing.update(event_data)
             event_data = existing
         except:
             pass
     
-    with open(filepath, 'w') as f:
-        json.dump(event_data, f, indent=2)
+    json_utils.dump_atomic(event_data, filepath)
+    metadata_index.put(consultation_id, filepath, event_data)
     
     print(f"[📋 WEBHOOK] Saved metadata for consultation {consultation_id}")
     if event_data.get('specialty'):
         print(f"[🎯 SPECIALTY] {event_data.get('specialty')}")
     return True
 
-def handle_consultation_started(data):
+async def handle_consultation_started(data):
     """Handle consultation started event"""
-    consultation_id = data.get('consultation_id')
+    consultation_id = data.consultation_id
     if not consultation_id:
-        return jsonify({'error': 'No consultation ID provided'}), 400
+        return FastJSONResponse({'error': 'No consultation ID provided'}, status_code=400)
     
     print(f"[📣 CONSULTATION STARTED] {consultation_id}")
     
     # Save event notification
-    if save_event_notification(data, 'consultation_started'):
-        return jsonify({'status': 'success', 'message': 'Consultation started event processed'})
+    if await asyncio.to_thread(save_event_notification, data, 'consultation_started'):
+        return {'status': 'success', 'message': 'Consultation started event processed'}
     
-    return jsonify({'error': 'Failed to save event notification'}), 500
+    return FastJSONResponse({'error': 'Failed to save event notification'}, status_code=500)
 
-@app.route('/webhook/telesalud', methods=['POST'])
-def handle_telesalud_webhook():
+@app.post('/webhook/telesalud')
+async def handle_telesalud_webhook(request: Request):
     """Handle incoming telesalud webhooks"""
     
     # Verify webhook token if configured
     if WEBHOOK_TOKEN:
         auth_header = request.headers.get('Authorization', '')
-        if not auth_header.startswith('Bearer ') or auth_header[7:] != WEBHOOK_TOKEN:
-            return jsonify({'error': 'Unauthorized'}), 401
+        # Constant-time compare; bytes so non-ASCII header values are rejected rather than raising
+        if not auth_header.startswith('Bearer ') or not hmac.compare_digest(auth_header[7:].encode(), WEBHOOK_TOKEN_BYTES):
+            return FastJSONResponse({'error': 'Unauthorized'}, status_code=401)
     
     try:
-        data = request.get_json()
-        if not data:
-            return jsonify({'error': 'No JSON data provided'}), 400
+        body = await request.body()
+        payload = TelesaludWebhook.model_validate_json(body) if body else None
+        if not payload or not payload.model_fields_set:
+            return FastJSONResponse({'error': 'No JSON data provided'}, status_code=400)
         
         # Handle new event-based format (from evolution.blade.php)
-        event = data.get('event')
-        if event == 'consultation_started':
-            return handle_consultation_started(data.get('data', {}))
+        if payload.event == 'consultation_started':
+            return await handle_consultation_started(payload.data)
         
         # Handle legacy format
-        vc_data = data.get('vc', {})
-        topic = data.get('topic', '')
+        vc_data = payload.vc
+        topic = payload.topic
+        
+        print(f"[🔗 WEBHOOK] Received {topic} for consultation {vc_data.secret}")
         
-        print(f"[🔗 WEBHOOK] Received {topic} for consultation {vc_data.get('secret')}")
+        if topic not in WEBHOOK_TOPICS:
+            return {'status': 'success', 'message': f'Topic {topic} ignored'}
         
         # Save event notification (minimal data only)
-        if save_event_notification(vc_data, topic):
+        if await asyncio.to_thread(save_event_notification, vc_data, topic):
             
             # Trigger pipeline processing if consultation is finished
             if topic == 'videoconsultation-finished':
-                consultation_id = vc_data.get('secret')
+                consultation_id = vc_data.secret
                 print(f"[🎬 FINISHED] Consultation {consultation_id} finished")
                 print(f"[🔐] Patient data will be retrieved securely when recording is processed")
 
@@ -177,229 +330,468 @@ def handle_telesalud_webhook():
                     # Trigger pipeline processing via wrapper script
                     trigger_pipeline_async(consultation_id)
         
-        return jsonify({'status': 'success', 'message': 'Webhook processed'})
+        return {'status': 'success', 'message': 'Webhook processed'}
         
+    except ValidationError as e:
+        print(f"[⚠️] Invalid webhook payload: {e}")
+        return FastJSONResponse({'error': str(e)}, status_code=400)
     except Exception as e:
         print(f"[❌ WEBHOOK ERROR] {str(e)}")
-        return jsonify({'error': str(e)}), 500
+        return FastJSONResponse({'error': str(e)}, status_code=500)
 
-@app.route('/webhook/health', methods=['GET'])
-def health_check():
+@app.get('/webhook/health')
+async def health_check():
     """Health check endpoint"""
-    return jsonify({
+    return {
         'status': 'healthy',
         'metadata_dir': METADATA_DIR,
         'active_rooms': len(active_rooms),
         'timestamp': datetime.now().isoformat()
-    })
+    }
 
 # ==========================================
 # Prosody Event Sync Endpoints (for speaker diarization)
 # ==========================================
 
-# In-memory storage for active rooms
+# In-memory storage for active rooms; each room's occupants are keyed by occupant JID
 active_rooms = {}
 
+
+# Prosody event payloads, parsed and validated in one pass by pydantic-core.
+# Unknown fields are kept so occupant records round-trip unchanged.
+class Occupant(BaseModel):
+    model_config = ConfigDict(extra='allow')
+
+    occupant_jid: str = ''
+    name: str | None = None  # Display name; may be missing or null, see occupant_name()
+    email: str | None = None
+    id: str | int | None = None
+    joined_at: int | float | str | None = None
+    left_at: int | float | str | None = None
+
+    # Prosody passes the display name through as given, which can be a number
+    @field_validator('name', mode='before')
+    @classmethod
+    def name_to_str(cls, value):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return str(value)
+        return value
+
+
+def occupant_name(occupant):
+    """Display name for an occupant dict, 'Unknown' when Prosody sent none"""
+    return occupant.get('name') or 'Unknown'
+
+
+class RoomCreatedEvent(BaseModel):
+    room_name: str
+    created_at: int | float | str | None = None
+    room_jid: str | None = None
+    is_breakout: bool = False
+
+    # Null is treated like a missing field, as the dict.get code this replaced did
+    @field_validator('is_breakout', mode='before')
+    @classmethod
+    def null_to_false(cls, value):
+        return False if value is None else value
+
+
+class RoomDestroyedEvent(BaseModel):
+    room_name: str
+    all_occupants: list[Occupant] = []
+
+    @field_validator('all_occupants', mode='before')
+    @classmethod
+    def null_to_empty(cls, value):
+        return [] if value is None else value
+
+
+class OccupantEvent(BaseModel):
+    room_name: str
+    occupant: Occupant = Field(default_factory=Occupant)
+
+
+def validation_error_response(error):
+    """Reject a malformed Prosody event"""
+    print(f"[⚠️] Invalid event payload: {error}")
+    return FastJSONResponse({'status': 'error', 'message': str(error)}, status_code=400)
+
 # Recordings directory (same as multitrack recorder)
 RECORDINGS_DIR = os.environ.get('RECORDINGS_DIR', '/data')
+RECORDINGS_PATH = Path(RECORDINGS_DIR)
+
+# Recording directories already found per room, so periodic flushes don't re-probe every suffix.
+# The recorder may create the directory after the room's first events, so a miss is only
+# remembered for ROOM_DIR_RETRY_INTERVAL seconds before the suffixes are probed again.
+_room_dirs = {}
+_room_dir_misses = {}
+ROOM_DIR_RETRY_INTERVAL = float(os.environ.get('ROOM_DIR_RETRY_INTERVAL', 5))
+
+# Occupant events only mark a room dirty; the flusher thread writes its mapping at most once per interval
+SPEAKER_MAPPING_FLUSH_INTERVAL = float(os.environ.get('SPEAKER_MAPPING_FLUSH_INTERVAL', 0.5))
+_dirty_rooms = set()
+_dirty_lock = threading.Lock()
+# Serializes mapping writes so a late periodic flush can't overwrite a room's final mapping
+_write_lock = threading.Lock()
+
+# Room/occupant state is also kept in SQLite (WAL) so each event writes one row and a restart doesn't lose rooms
+ROOMS_DB = os.path.join(METADATA_DIR, 'rooms.db')
+_rooms_db = None
+# The connection is opened and used only on this thread, so commits stay off the event loop and in event order
+_rooms_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rooms-db')
+
+
+def run_rooms_db(func, *args):
+    """Run func on the room state database thread; returns an awaitable"""
+    return asyncio.get_running_loop().run_in_executor(_rooms_db_executor, func, *args)
+
+
+def open_rooms_db():
+    """Open the room state database and reload rooms that were active before a restart"""
+    global _rooms_db
+    ensure_metadata_dir()
+    _rooms_db = sqlite3.connect(ROOMS_DB, isolation_level=None)
+    _rooms_db.execute('PRAGMA journal_mode=WAL')
+    _rooms_db.execute('PRAGMA synchronous=NORMAL')
+    _rooms_db.execute('CREATE TABLE IF NOT EXISTS rooms (name TEXT PRIMARY KEY, data TEXT NOT NULL)')
+    _rooms_db.execute(
+        'CREATE TABLE IF NOT EXISTS occupants ('
+        'room TEXT NOT NULL, jid TEXT NOT NULL, data TEXT NOT NULL, PRIMARY KEY (room, jid))'
+    )
+    
+    for name, data in _rooms_db.execute('SELECT name, data FROM rooms'):
+        room = json_utils.loads(data)
+        room['occupants'] = {}
+        active_rooms[name] = room
+    for room_name, jid, data in _rooms_db.execute('SELECT room, jid, data FROM occupants ORDER BY rowid'):
+        if room_name in active_rooms:
+            active_rooms[room_name]['occupants'][jid] = json_utils.loads(data)
+    
+    if active_rooms:
+        print(f"[🗄️ ROOMS] Restored {len(active_rooms)} active rooms from {ROOMS_DB}")
+
+
+UPSERT_OCCUPANT = 'INSERT INTO occupants VALUES (?, ?, ?) ON CONFLICT (room, jid) DO UPDATE SET data = excluded.data'
+
+
+def _occupant_row(room_name, occupant):
+    return room_name, occupant.get('occupant_jid', ''), json_utils.dumps(occupant).decode()
+
+
+@contextmanager
+def _rooms_transaction():
+    """Group statements into one transaction (the connection otherwise autocommits each one)"""
+    _rooms_db.execute('BEGIN')
+    try:
+        yield
+    except BaseException:
+        _rooms_db.execute('ROLLBACK')
+        raise
+    _rooms_db.execute('COMMIT')
+
+
+def _store_room(room_row, occupant_rows):
+    with _rooms_transaction():
+        # The stored occupants are replaced too, so a reused room name doesn't keep its previous occupants
+        _rooms_db.execute('DELETE FROM occupants WHERE room = ?', (room_row[0],))
+        _rooms_db.execute('INSERT OR REPLACE INTO rooms VALUES (?, ?)', room_row)
+        _rooms_db.executemany(UPSERT_OCCUPANT, occupant_rows)
+
+
+async def persist_room(room_name, room):
+    """Store a room's attributes and its current occupants (one row each)"""
+    # Rows are serialized here, before the event loop can change the room again
+    data = {key: value for key, value in room.items() if key != 'occupants'}
+    occupant_rows = [_occupant_row(room_name, occupant) for occupant in room['occupants'].values()]
+    await run_rooms_db(_store_room, (room_name, json_utils.dumps(data).decode()), occupant_rows)
+
+
+async def persist_occupant(room_name, occupant):
+    """Insert or update a single occupant row"""
+    await run_rooms_db(_rooms_db.execute, UPSERT_OCCUPANT, _occupant_row(room_name, occupant))
+
+
+def _delete_room(room_name):
+    with _rooms_transaction():
+        _rooms_db.execute('DELETE FROM occupants WHERE room = ?', (room_name,))
+        _rooms_db.execute('DELETE FROM rooms WHERE name = ?', (room_name,))
+
+
+async def forget_room(room_name):
+    """Remove a destroyed room and its occupants"""
+    await run_rooms_db(_delete_room, room_name)
 
 
 def get_room_dir(room_name):
     """Get the recording directory for a room"""
-    from pathlib import Path
-    return Path(RECORDINGS_DIR) / room_name
+    return RECORDINGS_PATH / room_name
+
+
+def find_room_dirs(room_name):
+    """Return the existing recording directories for a room (room might have suffix like -1)"""
+    dirs = _room_dirs.get(room_name)
+    if dirs is None:
+        last_miss = _room_dir_misses.get(room_name)
+        if last_miss is not None and time.monotonic() - last_miss < ROOM_DIR_RETRY_INTERVAL:
+            return []
+        
+        possible_dirs = [get_room_dir(room_name)]
+        for i in range(1, 10):
+            possible_dirs.append(get_room_dir(f"{room_name}-{i}"))
+        
+        dirs = [dir_path for dir_path in possible_dirs if dir_path.exists()]
+        if dirs:
+            _room_dirs[room_name] = dirs
+            _room_dir_misses.pop(room_name, None)
+        else:
+            _room_dir_misses[room_name] = time.monotonic()
+    return dirs
+
+
+def forget_room_dirs(room_name):
+    """Drop cached directory lookups so the next call probes the filesystem"""
+    _room_dirs.pop(room_name, None)
+    _room_dir_misses.pop(room_name, None)
+
+
+def jid_resource(jid):
+    """Extract resource from JID (e.g., "user@domain/resource" -> "resource"; bare JIDs are returned as-is)"""
+    return jid.rpartition('/')[2]
 
 
 def save_speaker_mapping(room_name, occupants):
     """Save speaker mapping to the recording directory for diarization"""
-    room_dir = get_room_dir(room_name)
+    room_dirs = find_room_dirs(room_name)
+    if not room_dirs:
+        print(f"[⚠️ SPEAKER] Recording directory not found for room: {room_name}")
+        return False
     
-    # Try multiple possible directories (room might have suffix like -1)
-    possible_dirs = [room_dir]
-    for i in range(1, 10):
-        possible_dirs.append(get_room_dir(f"{room_name}-{i}"))
+    # Create mapping from occupant_jid resource to occupant details (built once for all directories)
+    mapping = {
+        jid_resource(occ.get('occupant_jid', '')): {
+            'name': occupant_name(occ),
+            'email': occ.get('email'),
+            'id': occ.get('id'),
+            'joined_at': occ.get('joined_at'),
+            'left_at': occ.get('left_at')
+        }
+        for occ in occupants
+    }
     
-    saved = False
-    for dir_path in possible_dirs:
-        if dir_path.exists():
-            mapping_file = dir_path / 'speaker_mapping.json'
-            
-            # Create mapping from occupant_jid to name
-            mapping = {}
-            for occ in occupants:
-                jid = occ.get('occupant_jid', '')
-                # Extract resource from JID (e.g., "user@domain/resource" -> "resource")
-                resource = jid.split('/')[-1] if '/' in jid else jid
-                
-                mapping[resource] = {
-                    'name': occ.get('name', 'Unknown'),
-                    'email': occ.get('email'),
-                    'id': occ.get('id'),
-                    'joined_at': occ.get('joined_at'),
-                    'left_at': occ.get('left_at')
-                }
-            
-            with open(mapping_file, 'w') as f:
-                json.dump(mapping, f, indent=2)
-            
-            print(f"[💾 SPEAKER] Saved speaker mapping to {mapping_file}")
-            saved = True
+    for dir_path in room_dirs:
+        mapping_file = dir_path / 'speaker_mapping.json'
+        
+        # Write to a fsynced temp file and rename so readers never see a half-written mapping
+        json_utils.dump_atomic(mapping, mapping_file)
+        
+        print(f"[💾 SPEAKER] Saved speaker mapping to {mapping_file}")
     
-    if not saved:
-        print(f"[⚠️ SPEAKER] Recording directory not found for room: {room_name}")
+    return True
+
+
+def mark_speaker_mapping_dirty(room_name):
+    """Schedule a speaker mapping write for the room on the next flush"""
+    with _dirty_lock:
+        _dirty_rooms.add(room_name)
+
+
+def flush_speaker_mappings():
+    """Write speaker mappings for all rooms with pending occupant changes"""
+    with _dirty_lock:
+        rooms = list(_dirty_rooms)
+        _dirty_rooms.clear()
     
-    return saved
+    with _write_lock:
+        for room_name in rooms:
+            room = active_rooms.get(room_name)
+            if room is not None:
+                save_speaker_mapping(room_name, list(room['occupants'].values()))
 
 
-@app.route('/events/room/created', methods=['POST'])
-def room_created():
+def save_final_speaker_mapping(room_name, occupants):
+    """Write the final speaker mapping for a destroyed room, superseding pending flushes"""
+    with _dirty_lock:
+        _dirty_rooms.discard(room_name)
+    
+    with _write_lock:
+        # Probe again for the final write so directories created mid-call are included
+        forget_room_dirs(room_name)
+        saved = save_speaker_mapping(room_name, occupants)
+        forget_room_dirs(room_name)
+        return saved
+
+
+def speaker_mapping_flusher():
+    """Background loop that coalesces speaker mapping writes"""
+    while True:
+        time.sleep(SPEAKER_MAPPING_FLUSH_INTERVAL)
+        try:
+            flush_speaker_mappings()
+        except Exception as e:
+            print(f"[❌] Error flushing speaker mappings: {e}")
+
+
+@app.post('/events/room/created')
+async def room_created(request: Request):
     """Handle Prosody room created event"""
     try:
-        data = request.get_json()
-        room_name = data.get('room_name')
+        event = RoomCreatedEvent.model_validate_json(await request.body())
+        room_name = event.room_name
         
         print(f"[🏠 ROOM CREATED] {room_name}")
         
         # Initialize room tracking
         active_rooms[room_name] = {
-            'created_at': data.get('created_at'),
-            'room_jid': data.get('room_jid'),
-            'is_breakout': data.get('is_breakout', False),
-            'occupants': []
+            'created_at': event.created_at,
+            'room_jid': event.room_jid,
+            'is_breakout': event.is_breakout,
+            'occupants': {}
         }
+        await persist_room(room_name, active_rooms[room_name])
         
-        return jsonify({'status': 'ok', 'message': f'Room {room_name} created'}), 200
+        return {'status': 'ok', 'message': f'Room {room_name} created'}
         
+    except ValidationError as e:
+        return validation_error_response(e)
     except Exception as e:
         print(f"[❌] Error handling room created: {e}")
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+        return FastJSONResponse({'status': 'error', 'message': str(e)}, status_code=500)
 
 
-@app.route('/events/room/destroyed', methods=['POST'])
-def room_destroyed():
+@app.post('/events/room/destroyed')
+async def room_destroyed(request: Request):
     """Handle Prosody room destroyed event - save final speaker mapping"""
     try:
-        data = request.get_json()
-        room_name = data.get('room_name')
-        all_occupants = data.get('all_occupants', [])
-        
-        print(f"[🏚️ ROOM DESTROYED] {room_name} with {len(all_occupants)} total occupants")
+        event = RoomDestroyedEvent.model_validate_json(await request.body())
+        room_name = event.room_name
+        all_occupants = [occ.model_dump() for occ in event.all_occupants]
         
-        # Log all participants
-        for occ in all_occupants:
-            print(f"  👤 {occ.get('name', 'Unknown')} - joined: {occ.get('joined_at')}, left: {occ.get('left_at')}")
+        # Log all participants in one write
+        print("\n".join([f"[🏚️ ROOM DESTROYED] {room_name} with {len(all_occupants)} total occupants"] + [
+            f"  👤 {occupant_name(occ)} - joined: {occ.get('joined_at')}, left: {occ.get('left_at')}"
+            for occ in all_occupants
+        ]))
         
-        # Save final speaker mapping
-        save_speaker_mapping(room_name, all_occupants)
+        # Stop tracking the room first so the flusher skips it, then save the final speaker mapping
+        active_rooms.pop(room_name, None)
+        await forget_room(room_name)
+        await asyncio.to_thread(save_final_speaker_mapping, room_name, all_occupants)
         
-        # Clean up active rooms
-        if room_name in active_rooms:
-            del active_rooms[room_name]
-        
-        return jsonify({'status': 'ok', 'message': f'Room {room_name} destroyed, speaker mapping saved'}), 200
+        return {'status': 'ok', 'message': f'Room {room_name} destroyed, speaker mapping saved'}
         
+    except ValidationError as e:
+        return validation_error_response(e)
     except Exception as e:
         print(f"[❌] Error handling room destroyed: {e}")
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+        return FastJSONResponse({'status': 'error', 'message': str(e)}, status_code=500)
 
 
-@app.route('/events/occupant/joined', methods=['POST'])
-def occupant_joined():
+@app.post('/events/occupant/joined')
+async def occupant_joined(request: Request):
     """Handle Prosody occupant joined event"""
     try:
-        data = request.get_json()
-        room_name = data.get('room_name')
-        occupant = data.get('occupant', {})
-        
-        name = occupant.get('name', 'Unknown')
-        occupant_jid = occupant.get('occupant_jid', '')
+        event = OccupantEvent.model_validate_json(await request.body())
+        room_name = event.room_name
+        occupant = event.occupant.model_dump()
+        occupant_jid = event.occupant.occupant_jid
+        name = event.occupant.name or 'Unknown'
         
         print(f"[👤 JOINED] {name} joined {room_name}")
         
         # Update room tracking
         if room_name in active_rooms:
-            active_rooms[room_name]['occupants'].append(occupant)
-            # Save intermediate speaker mapping
-            save_speaker_mapping(room_name, active_rooms[room_name]['occupants'])
+            # A rejoin under the same JID replaces the earlier record, as the occupants table does
+            active_rooms[room_name]['occupants'][occupant_jid] = occupant
+            # Intermediate speaker mapping is written by the flusher
+            mark_speaker_mapping_dirty(room_name)
+            await persist_occupant(room_name, occupant)
         else:
             # Room wasn't tracked, create it now
             active_rooms[room_name] = {
                 'created_at': datetime.now().timestamp(),
-                'occupants': [occupant]
+                'occupants': {occupant_jid: occupant}
             }
+            await persist_room(room_name, active_rooms[room_name])
         
-        return jsonify({'status': 'ok', 'message': f'{name} joined {room_name}'}), 200
+        return {'status': 'ok', 'message': f'{name} joined {room_name}'}
         
+    except ValidationError as e:
+        return validation_error_response(e)
     except Exception as e:
         print(f"[❌] Error handling occupant joined: {e}")
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+        return FastJSONResponse({'status': 'error', 'message': str(e)}, status_code=500)
 
 
-@app.route('/events/occupant/left', methods=['POST'])
-def occupant_left():
+@app.post('/events/occupant/left')
+async def occupant_left(request: Request):
     """Handle Prosody occupant left event"""
     try:
-        data = request.get_json()
-        room_name = data.get('room_name')
-        occupant = data.get('occupant', {})
-        
-        name = occupant.get('name', 'Unknown')
-        occupant_jid = occupant.get('occupant_jid', '')
+        event = OccupantEvent.model_validate_json(await request.body())
+        room_name = event.room_name
+        name = event.occupant.name or 'Unknown'
+        occupant_jid = event.occupant.occupant_jid
         
         print(f"[👋 LEFT] {name} left {room_name}")
         
         # Update room tracking with left_at time
         if room_name in active_rooms:
-            for occ in active_rooms[room_name]['occupants']:
-                if occ.get('occupant_jid') == occupant_jid:
-                    occ['left_at'] = occupant.get('left_at')
-                    break
-            # Save updated speaker mapping
-            save_speaker_mapping(room_name, active_rooms[room_name]['occupants'])
+            occ = active_rooms[room_name]['occupants'].get(occupant_jid)
+            # Updated speaker mapping is written by the flusher
+            mark_speaker_mapping_dirty(room_name)
+            if occ is not None:
+                occ['left_at'] = event.occupant.left_at
+                await persist_occupant(room_name, occ)
         
-        return jsonify({'status': 'ok', 'message': f'{name} left {room_name}'}), 200
+        return {'status': 'ok', 'message': f'{name} left {room_name}'}
         
+    except ValidationError as e:
+        return validation_error_response(e)
     except Exception as e:
         print(f"[❌] Error handling occupant left: {e}")
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+        return FastJSONResponse({'status': 'error', 'message': str(e)}, status_code=500)
 
 
-@app.route('/events/rooms', methods=['GET'])
-def list_active_rooms():
+@app.get('/events/rooms')
+async def list_active_rooms():
     """List active rooms (for debugging)"""
-    return jsonify(active_rooms), 200
+    return {
+        room_name: {**room, 'occupants': list(room['occupants'].values())}
+        for room_name, room in active_rooms.items()
+    }
 
-@app.route('/webhook/consultations', methods=['GET'])
+@app.get('/webhook/consultations')
 def list_consultations():
     """List stored consultation metadata"""
+    # Plain def: FastAPI runs it in its threadpool, so the index read stays off the event loop
     ensure_metadata_dir()
     
-    consultations = []
-    for filename in os.listdir(METADATA_DIR):
-        if filename.endswith('_metadata.json'):
-            filepath = os.path.join(METADATA_DIR, filename)
-            try:
-                with open(filepath, 'r') as f:
-                    metadata = json.load(f)
-                    consultations.append({
-                        'consultation_id': metadata.get('consultation_id'),
-                        'status': metadata.get('status'),
-                        'topic': metadata.get('topic'),
-                        'recording_processed': metadata.get('recording_processed', False),
-                        'webhook_received': metadata.get('webhook_received')
-                    })
-            except Exception as e:
-                print(f"[⚠️] Error reading {filename}: {e}")
+    # A fresh instance reads the current index file, including entries written by other processes
+    consultations = [
+        {
+            'consultation_id': consultation_id,
+            'status': entry.get('status'),
+            'topic': entry.get('topic'),
+            'recording_processed': entry.get('recording_processed', False),
+            'webhook_received': entry.get('webhook_received')
+        }
+        for consultation_id, entry in MetadataIndex(METADATA_DIR).entries().items()
+    ]
     
-    return jsonify({'consultations': consultations})
+    return {'consultations': consultations}
 
 def run_webhook_server():
     """Run the webhook server"""
     port = int(os.environ.get('WEBHOOK_PORT', 9091))
     host = os.environ.get('WEBHOOK_HOST', '0.0.0.0')
+    # Prosody posts room/occupant events in bursts over a few long-lived connections;
+    # keep them open between events and queue bursts instead of refusing them
+    keep_alive = int(os.environ.get('WEBHOOK_KEEP_ALIVE', 30))
+    backlog = int(os.environ.get('WEBHOOK_BACKLOG', 2048))
     
     print(f"[🌐 WEBHOOK] Starting webhook server on {host}:{port}")
-    app.run(host=host, port=port, debug=False)
+    # Single worker: active_rooms lives in process memory, so every Prosody event
+    # for a room must reach the same process. Uvicorn picks uvloop/httptools when installed.
+    uvicorn.run(app, host=host, port=port, timeout_keep_alive=keep_alive, backlog=backlog)
 
 if __name__ == '__main__':
     run_webhook_server()
\ No newline at end of file
@@ -5,14 +5,20 @@ Maintains context and evaluation progress for different consultation types
 """
 import json
 import asyncio
+import heapq
+import os
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Any
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, field
 from enum import Enum
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Upper bound on sessions held in memory, in case cleanup falls behind or sessions are never closed
+MAX_ACTIVE_SESSIONS = int(os.environ.get("MAX_ACTIVE_SESSIONS", 1000))
+
 class ConsultationType(Enum):
     AUTISM = "autism"
     ADHD = "adhd"
@@ -20,30 +26,37 @@ class ConsultationType(Enum):
     DEPRESSION = "depression"
     ANXIETY = "anxiety"
 
-@dataclass
+# slots=True drops the per-instance __dict__; sessions hold hundreds of segments
+@dataclass(slots=True)
 class ConversationSegment:
     speaker: str
     text: str
     timestamp: datetime
     confidence: float = 0.0
     processed: bool = False
-    indicators: List[str] = None
+    indicators: List[str] = field(default_factory=list)
+    # Serialized form, reused across context requests until the segment changes
+    _dict: Optional[dict] = field(default=None, init=False, repr=False, compare=False)
     
-    def __post_init__(self):
-        if self.indicators is None:
-            self.indicators = []
+    def mark_processed(self, indicators: List[str] = None):
+        self.processed = True
+        if indicators:
+            self.indicators.extend(indicators)
+        self._dict = None
     
     def to_dict(self) -> dict:
-        return {
-            "speaker": self.speaker,
-            "text": self.text,
-            "timestamp": self.timestamp.isoformat(),
-            "confidence": self.confidence,
-            "processed": self.processed,
-            "indicators": self.indicators
-        }
+        if self._dict is None:
+            self._dict = {
+                "speaker": self.speaker,
+                "text": self.text,
+                "timestamp": self.timestamp.isoformat(),
+                "confidence": self.confidence,
+                "processed": self.processed,
+                "indicators": list(self.indicators)
+            }
+        return self._dict
 
-@dataclass
+@dataclass(slots=True)
 class EvaluationProgress:
     areas_assessed: Dict[str, bool]
     indicators_found: List[str]
@@ -53,79 +66,93 @@ class EvaluationProgress:
     completion_percentage: float
     
     def to_dict(self) -> dict:
-        return asdict(self)
+        # Built by hand: asdict() deep-copies every field recursively, and this runs for each
+        # analysis request and for every session in /sessions and /health
+        return {
+            "areas_assessed": dict(self.areas_assessed),
+            "indicators_found": list(self.indicators_found),
+            "confidence_level": self.confidence_level,
+            "next_focus_areas": list(self.next_focus_areas),
+            "questions_asked": self.questions_asked,
+            "completion_percentage": self.completion_percentage
+        }
+
+# Consultation-specific evaluation frameworks, shared read-only by every session
+EVALUATION_FRAMEWORKS = {
+    ConsultationType.AUTISM: {
+        "areas": (
+            "social_communication",
+            "restricted_repetitive_behaviors", 
+            "sensory_processing",
+            "developmental_history",
+            "adaptive_functioning",
+            "cognitive_assessment"
+        ),
+        "key_indicators": (
+            "eye_contact_differences",
+            "social_reciprocity_challenges",
+            "repetitive_behaviors",
+            "sensory_sensitivities",
+            "communication_differences",
+            "developmental_delays"
+        )
+    },
+    ConsultationType.ADHD: {
+        "areas": (
+            "inattention_symptoms",
+            "hyperactivity_symptoms",
+            "impulsivity_symptoms",
+            "functional_impairment",
+            "developmental_history",
+            "comorbid_conditions"
+        ),
+        "key_indicators": (
+            "attention_difficulties",
+            "hyperactive_behaviors",
+            "impulsive_actions",
+            "executive_function_challenges",
+            "academic_challenges",
+            "social_difficulties"
+        )
+    },
+    ConsultationType.GENERAL: {
+        "areas": (
+            "chief_complaint",
+            "history_present_illness",
+            "review_of_systems",
+            "medical_history",
+            "social_history",
+            "assessment_plan"
+        ),
+        "key_indicators": (
+            "symptom_onset",
+            "symptom_severity",
+            "functional_impact",
+            "risk_factors",
+            "protective_factors"
+        )
+    }
+}
 
 class ConversationStateManager:
     def __init__(self, consultation_id: str, consultation_type: ConsultationType):
         self.consultation_id = consultation_id
         self.consultation_type = consultation_type
         self.conversation_segments: List[ConversationSegment] = []
+        # Patient statements awaiting analysis, oldest first; processed ones are dropped lazily
+        self._unprocessed_patient: deque = deque()
+        # Per-speaker totals for session summaries, kept as segments are added
+        self._patient_count = 0
+        self._provider_count = 0
         self.evaluation_progress = self.initialize_evaluation_progress()
         self.session_start_time = datetime.now()
         self.last_activity_time = datetime.now()
         self.context_window_size = 10  # Number of recent segments to include in context
-        
-        # Consultation-specific evaluation frameworks
-        self.evaluation_frameworks = {
-            ConsultationType.AUTISM: {
-                "areas": [
-                    "social_communication",
-                    "restricted_repetitive_behaviors", 
-                    "sensory_processing",
-                    "developmental_history",
-                    "adaptive_functioning",
-                    "cognitive_assessment"
-                ],
-                "key_indicators": [
-                    "eye_contact_differences",
-                    "social_reciprocity_challenges",
-                    "repetitive_behaviors",
-                    "sensory_sensitivities",
-                    "communication_differences",
-                    "developmental_delays"
-                ]
-            },
-            ConsultationType.ADHD: {
-                "areas": [
-                    "inattention_symptoms",
-                    "hyperactivity_symptoms",
-                    "impulsivity_symptoms",
-                    "functional_impairment",
-                    "developmental_history",
-                    "comorbid_conditions"
-                ],
-                "key_indicators": [
-                    "attention_difficulties",
-                    "hyperactive_behaviors",
-                    "impulsive_actions",
-                    "executive_function_challenges",
-                    "academic_challenges",
-                    "social_difficulties"
-                ]
-            },
-            ConsultationType.GENERAL: {
-                "areas": [
-                    "chief_complaint",
-                    "history_present_illness",
-                    "review_of_systems",
-                    "medical_history",
-                    "social_history",
-                    "assessment_plan"
-                ],
-                "key_indicators": [
-                    "symptom_onset",
-                    "symptom_severity",
-                    "functional_impact",
-                    "risk_factors",
-                    "protective_factors"
-                ]
-            }
-        }
     
     def initialize_evaluation_progress(self) -> EvaluationProgress:
         """Initialize evaluation progress based on consultation type"""
-        framework = self.evaluation_frameworks.get(self.consultation_type, 
-                                                   self.evaluation_frameworks[ConsultationType.GENERAL])
+        framework = EVALUATION_FRAMEWORKS.get(self.consultation_type,
+                                              EVALUATION_FRAMEWORKS[ConsultationType.GENERAL])
         
         areas_assessed = {area: False for area in framework["areas"]}
         
@@ -133,43 +160,49 @@ class ConversationStateManager:
             areas_assessed=areas_assessed,
             indicators_found=[],
             confidence_level=0.0,
-            next_focus_areas=framework["areas"][:3],  # Start with first 3 areas
+            next_focus_areas=list(framework["areas"][:3]),  # Start with first 3 areas
             questions_asked=0,
             completion_percentage=0.0
         )
     
     async def add_patient_statement(self, text: str, confidence: float = 0.0) -> ConversationSegment:
         """Add a new patient statement to the conversation"""
+        # One clock read stamps both the segment and the session activity
+        now = datetime.now()
         segment = ConversationSegment(
             speaker="patient",
             text=text.strip(),
-            timestamp=datetime.now(),
+            timestamp=now,
             confidence=confidence,
             processed=False
         )
         
         self.conversation_segments.append(segment)
-        self.last_activity_time = datetime.now()
+        self._unprocessed_patient.append(segment)
+        self._patient_count += 1
+        self.last_activity_time = now
         
-        logger.info(f"Added patient statement to consultation {self.consultation_id}: {text[:50]}...")
+        logger.info("Added patient statement to consultation %s: %.50s...", self.consultation_id, text)
         
         return segment
     
     async def add_provider_statement(self, text: str) -> ConversationSegment:
         """Add a provider statement/question to the conversation"""
+        now = datetime.now()
         segment = ConversationSegment(
             speaker="provider",
             text=text.strip(),
-            timestamp=datetime.now(),
+            timestamp=now,
             confidence=1.0,  # Provider statements are always high confidence
             processed=True   # Provider statements don't need AI analysis
         )
         
         self.conversation_segments.append(segment)
+        self._provider_count += 1
         self.evaluation_progress.questions_asked += 1
-        self.last_activity_time = datetime.now()
+        self.last_activity_time = now
         
-        logger.info(f"Added provider question to consultation {self.consultation_id}")
+        logger.info("Added provider question to consultation %s", self.consultation_id)
         
         return segment
     
@@ -183,17 +216,15 @@ class ConversationStateManager:
     
     def get_unprocessed_patient_statements(self) -> List[ConversationSegment]:
         """Get patient statements that haven't been processed yet"""
-        return [
-            segment for segment in self.conversation_segments 
-            if segment.speaker == "patient" and not segment.processed
-        ]
+        return [segment for segment in self._unprocessed_patient if not segment.processed]
     
     def mark_segment_processed(self, segment: ConversationSegment, indicators: List[str] = None):
         """Mark a segment as processed and add any identified indicators"""
-        segment.processed = True
+        segment.mark_processed(indicators)
+        while self._unprocessed_patient and self._unprocessed_patient[0].processed:
+            self._unprocessed_patient.popleft()
         
         if indicators:
-            segment.indicators.extend(indicators)
             self.evaluation_progress.indicators_found.extend(indicators)
         
         # Update completion percentage
@@ -213,16 +244,13 @@ class ConversationStateManager:
             if area in self.evaluation_progress.next_focus_areas:
                 self.evaluation_progress.next_focus_areas.remove(area)
                 
-            # Add next unassessed area if available
-            unassessed_areas = [
-                area for area, assessed in self.evaluation_progress.areas_assessed.items()
-                if not assessed
-            ]
-            
-            if unassessed_areas and len(self.evaluation_progress.next_focus_areas) < 3:
-                next_area = unassessed_areas[0]
-                if next_area not in self.evaluation_progress.next_focus_areas:
-                    self.evaluation_progress.next_focus_areas.append(next_area)
+            # Add the next unassessed area that isn't already queued, in framework order
+            focus_areas = self.evaluation_progress.next_focus_areas
+            if len(focus_areas) < 3:
+                for candidate, assessed in self.evaluation_progress.areas_assessed.items():
+                    if not assessed and candidate not in focus_areas:
+                        focus_areas.append(candidate)
+                        break
     
     def get_context_for_ai_analysis(self) -> Dict[str, Any]:
         """Prepare context data for AI analysis"""
@@ -235,25 +263,21 @@ class ConversationStateManager:
             "unprocessed_statements": [
                 segment.to_dict() for segment in self.get_unprocessed_patient_statements()
             ],
-            "key_indicators_framework": self.evaluation_frameworks[self.consultation_type]["key_indicators"],
+            "key_indicators_framework": EVALUATION_FRAMEWORKS[self.consultation_type]["key_indicators"],
             "focus_areas": self.evaluation_progress.next_focus_areas
         }
     
     def get_session_summary(self) -> Dict[str, Any]:
         """Get summary of the current session"""
-        total_segments = len(self.conversation_segments)
-        patient_segments = len([s for s in self.conversation_segments if s.speaker == "patient"])
-        provider_segments = len([s for s in self.conversation_segments if s.speaker == "provider"])
-        
         return {
             "consultation_id": self.consultation_id,
             "consultation_type": self.consultation_type.value,
             "session_start": self.session_start_time.isoformat(),
             "last_activity": self.last_activity_time.isoformat(),
             "duration_minutes": (datetime.now() - self.session_start_time).total_seconds() / 60,
-            "total_segments": total_segments,
-            "patient_statements": patient_segments,
-            "provider_questions": provider_segments,
+            "total_segments": len(self.conversation_segments),
+            "patient_statements": self._patient_count,
+            "provider_questions": self._provider_count,
             "evaluation_progress": self.evaluation_progress.to_dict(),
             "indicators_found": len(self.evaluation_progress.indicators_found),
             "completion_percentage": self.evaluation_progress.completion_percentage
@@ -275,8 +299,19 @@ class ConversationStateManager:
 # Session manager to handle multiple active consultations
 class SessionManager:
     def __init__(self):
-        self.active_sessions: Dict[str, ConversationStateManager] = {}
+        # Least recently used first, so the oldest session is evicted when the cap is reached
+        self.active_sessions: "OrderedDict[str, ConversationStateManager]" = OrderedDict()
         self.session_timeout_minutes = 60  # Auto-cleanup after 1 hour of inactivity
+        # (expiry, consultation_id), earliest first; entries for sessions with newer activity are re-queued when they surface
+        self._expiry_heap: List[tuple] = []
+    
+    def _schedule_expiry(self, consultation_id: str, session: ConversationStateManager):
+        expiry = session.last_activity_time + timedelta(minutes=self.session_timeout_minutes)
+        heapq.heappush(self._expiry_heap, (expiry, consultation_id))
+    
+    def next_expiry(self) -> Optional[datetime]:
+        """When the earliest tracked session could expire, or None if there are none"""
+        return self._expiry_heap[0][0] if self._expiry_heap else None
     
     async def create_session(self, consultation_id: str, consultation_type: str) -> ConversationStateManager:
         """Create a new conversation session"""
@@ -288,6 +323,15 @@ class SessionManager:
         
         session = ConversationStateManager(consultation_id, consult_type)
         self.active_sessions[consultation_id] = session
+        self.active_sessions.move_to_end(consultation_id)
+        self._schedule_expiry(consultation_id, session)
+        
+        while len(self.active_sessions) > MAX_ACTIVE_SESSIONS:
+            evicted_id, evicted = self.active_sessions.popitem(last=False)
+            logger.warning(
+                f"Session limit ({MAX_ACTIVE_SESSIONS}) reached, evicting least recently used session {evicted_id} "
+                f"({len(evicted.conversation_segments)} segments)"
+            )
         
         logger.info(f"Created new session for consultation {consultation_id} (type: {consult_type.value})")
         
@@ -295,20 +339,35 @@ class SessionManager:
     
     def get_session(self, consultation_id: str) -> Optional[ConversationStateManager]:
         """Get existing session by consultation ID"""
-        return self.active_sessions.get(consultation_id)
+        session = self.active_sessions.get(consultation_id)
+        if session is not None:
+            self.active_sessions.move_to_end(consultation_id)
+        return session
+    
+    def remove_session(self, consultation_id: str) -> Optional[ConversationStateManager]:
+        """Remove a session and return it, or None if it was not active"""
+        return self.active_sessions.pop(consultation_id, None)
     
     async def cleanup_inactive_sessions(self):
         """Remove inactive sessions to free memory"""
-        inactive_sessions = [
-            consultation_id for consultation_id, session in self.active_sessions.items()
-            if not session.is_session_active(self.session_timeout_minutes)
-        ]
+        now = datetime.now()
+        cleaned_count = 0
         
-        for consultation_id in inactive_sessions:
-            logger.info(f"Cleaning up inactive session: {consultation_id}")
-            del self.active_sessions[consultation_id]
+        # Only sessions whose expiry has passed are looked at
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            _, consultation_id = heapq.heappop(self._expiry_heap)
+            session = self.active_sessions.get(consultation_id)
+            if session is None:
+                continue  # Already removed when its connection ended
+            
+            if session.is_session_active(self.session_timeout_minutes):
+                self._schedule_expiry(consultation_id, session)
+            else:
+                logger.info(f"Cleaning up inactive session: {consultation_id}")
+                del self.active_sessions[consultation_id]
+                cleaned_count += 1
         
-        return len(inactive_sessions)
+        return cleaned_count
     
     def get_all_active_sessions(self) -> Dict[str, Dict[str, Any]]:
         """Get summary of all active sessions"""
@@ -331,5 +390,9 @@ async def periodic_cleanup():
         except Exception as e:
             logger.error(f"Error during session cleanup: {e}")
         
-        # Run cleanup every 10 minutes
-        await asyncio.sleep(600)
\ No newline at end of file
+        # Sleep until the next session could expire, checking at least every 10 minutes
+        delay = 600
+        next_expiry = session_manager.next_expiry()
+        if next_expiry is not None:
+            delay = min(delay, max((next_expiry - datetime.now()).total_seconds(), 1))
+        await asyncio.sleep(delay)
\ No newline at end of file
@@ -3,27 +3,43 @@
 Health check endpoint for Real-Time Clinical Assistant
 """
 import asyncio
-import json
+import time
 from datetime import datetime
 from aiohttp import web
 import logging
+import json_utils
 
 logger = logging.getLogger(__name__)
 
+# Everything in the healthy response except the timestamp is constant, so the body
+# is serialized once per second and shared by every request in that second
+_HEALTHY_STATUS = {
+    "status": "healthy",
+    "service": "realtime-clinical-assistant",
+    "version": "1.0.0"
+}
+_cached_second = None
+_cached_body = b""
+
+def _healthy_body() -> bytes:
+    """Return the healthy response body, refreshing its timestamp at most once per second"""
+    global _cached_second, _cached_body
+    now = time.time()
+    second = int(now)
+    if second != _cached_second:
+        _cached_second = second
+        _cached_body = json_utils.dumps(
+            {**_HEALTHY_STATUS, "timestamp": datetime.fromtimestamp(now).isoformat()}
+        ).encode()
+    return _cached_body
+
 async def health_check(request):
     """Health check endpoint"""
     try:
         # You could add more sophisticated health checks here
         # e.g., check Parakeet connectivity, database health, etc.
         
-        health_status = {
-            "status": "healthy",
-            "timestamp": datetime.now().isoformat(),
-            "service": "realtime-clinical-assistant",
-            "version": "1.0.0"
-        }
-        
-        return web.json_response(health_status)
+        return web.Response(body=_healthy_body(), content_type="application/json")
         
     except Exception as e:
         logger.error(f"Health check failed: {e}")
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+JSON helpers for the websocket message paths
+Uses orjson when it is installed and falls back to the stdlib json module
+"""
+import json
+from datetime import date, datetime, time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so one except clause covers both
+JSONDecodeError = json.JSONDecodeError
+
+
+def loads(data):
+    """Parse JSON from str or bytes"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj):
+    """Serialize obj to a JSON str (websocket text frames need str, not bytes)"""
+    if orjson is not None:
+        # numpy is used for audio here; serialize its scalars instead of raising
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+    return json.dumps(obj, default=_isoformat)
+
+
+def _isoformat(value):
+    """Match orjson, which writes datetimes as ISO 8601 strings natively"""
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
@@ -5,17 +5,22 @@ Connects to existing Parakeet FastAPI WebSocket for real-time transcription
 """
 import asyncio
 import websockets
-import json
 import logging
 import os
-from typing import Optional, Callable, Any
+from typing import Optional, Callable, Any, Union
 import numpy as np
+import json_utils
 
 logger = logging.getLogger(__name__)
 
 # Default Parakeet URL from environment
 DEFAULT_PARAKEET_URL = os.environ.get("PARAKEET_WS_URL", "ws://parakeet-asr:8000/ws")
 
+# Audio chunks arriving within this window are sent to Parakeet as one frame (0 sends each chunk as it arrives)
+AUDIO_BATCH_SECONDS = float(os.environ.get("AUDIO_BATCH_MS", 20)) / 1000
+# Send early once this much audio is buffered (64 KB is about 2 s of 16 kHz int16)
+AUDIO_BATCH_MAX_BYTES = 64 * 1024
+
 class ParakeetWebSocketClient:
     """Client for connecting to Parakeet's WebSocket transcription service"""
     
@@ -51,12 +56,12 @@ class ParakeetWebSocketClient:
             self.is_connected = False
             logger.info("Disconnected from Parakeet WebSocket")
     
-    async def send_audio_chunk(self, audio_data: bytes):
+    async def send_audio_chunk(self, audio_data: Union[bytes, bytearray]):
         """
         Send audio chunk to Parakeet for transcription
         
         Args:
-            audio_data: Raw audio bytes (16kHz mono PCM, int16)
+            audio_data: Raw audio bytes (16kHz mono PCM, int16); sent as a binary frame
         """
         if not self.is_connected or not self.websocket:
             logger.warning("Not connected to Parakeet WebSocket")
@@ -64,7 +69,7 @@ class ParakeetWebSocketClient:
         
         try:
             await self.websocket.send(audio_data)
-            logger.debug(f"Sent audio chunk of {len(audio_data)} bytes")
+            logger.debug("Sent audio chunk of %d bytes", len(audio_data))
         except Exception as e:
             logger.error(f"Error sending audio chunk: {e}")
             self.is_connected = False
@@ -112,12 +117,12 @@ class ParakeetWebSocketClient:
         """Handle incoming transcription message from Parakeet"""
         try:
             # Parse JSON message
-            data = json.loads(message)
+            data = json_utils.loads(message)
             
             # Handle different message types
             if "status" in data:
                 # Status message (e.g., {"status": "queued"})
-                logger.debug(f"Parakeet status: {data['status']}")
+                logger.debug("Parakeet status: %s", data['status'])
                 
             elif "text" in data:
                 # Transcription result
@@ -125,10 +130,10 @@ class ParakeetWebSocketClient:
                 confidence = data.get("confidence", 0.0)
                 
                 if text and self.transcription_callback:
-                    logger.info(f"Received transcription: {text}")
+                    logger.info("Received transcription: %s", text)
                     await self.transcription_callback(text, confidence)
                     
-        except json.JSONDecodeError:
+        except json_utils.JSONDecodeError:
             logger.warning(f"Received non-JSON message: {message}")
         except Exception as e:
             logger.error(f"Error handling transcription message: {e}")
@@ -141,6 +146,9 @@ class AudioForwarder:
         self.transcription_processor = transcription_processor
         self.parakeet_client = ParakeetWebSocketClient()
         self.is_active = False
+        self._audio_buffer = bytearray()
+        self._flush_task = None
+        self._listen_task = None
         
         # Set up transcription callback
         self.parakeet_client.set_transcription_callback(self.on_transcription)
@@ -151,8 +159,8 @@ class AudioForwarder:
             await self.parakeet_client.connect()
             self.is_active = True
             
-            # Start listening for transcriptions in background
-            asyncio.create_task(self.parakeet_client.listen_for_transcriptions())
+            # Start listening for transcriptions in background (keep the task so stop() can cancel it)
+            self._listen_task = asyncio.create_task(self.parakeet_client.listen_for_transcriptions())
             
             logger.info(f"Audio forwarder started for consultation {self.consultation_id}")
             
@@ -162,13 +170,42 @@ class AudioForwarder:
     
     async def stop(self):
         """Stop the audio forwarding service"""
+        if self._flush_task:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self._flush_audio()
         self.is_active = False
+        # Cancel the listener first, otherwise it treats the disconnect as a dropped connection and reconnects
+        if self._listen_task:
+            self._listen_task.cancel()
+            self._listen_task = None
         await self.parakeet_client.disconnect()
         logger.info(f"Audio forwarder stopped for consultation {self.consultation_id}")
     
     async def forward_audio_chunk(self, audio_data: bytes):
-        """Forward audio chunk from telesalud to Parakeet"""
-        if self.is_active:
+        """Forward audio chunk from telesalud to Parakeet, coalescing chunks that arrive close together"""
+        if not self.is_active:
+            return
+        if AUDIO_BATCH_SECONDS <= 0:
+            await self.parakeet_client.send_audio_chunk(audio_data)
+            return
+        
+        self._audio_buffer += audio_data
+        if len(self._audio_buffer) >= AUDIO_BATCH_MAX_BYTES:
+            await self._flush_audio()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_audio_later())
+    
+    async def _flush_audio_later(self):
+        await asyncio.sleep(AUDIO_BATCH_SECONDS)
+        self._flush_task = None
+        await self._flush_audio()
+    
+    async def _flush_audio(self):
+        """Send whatever audio is buffered as a single frame"""
+        if self._audio_buffer:
+            # Hand the buffer itself to the send and start a fresh one, rather than copying it into bytes
+            audio_data, self._audio_buffer = self._audio_buffer, bytearray()
             await self.parakeet_client.send_audio_chunk(audio_data)
     
     async def on_transcription(self, text: str, confidence: float):
@@ -200,7 +237,7 @@ class TranscriptionProcessor:
             # Queue the transcription for clinical analysis
             await self.clinical_engine.queue_patient_statement(session, text)
             
-            logger.info(f"Processed transcription for {consultation_id}: {text[:50]}...")
+            logger.info("Processed transcription for %s: %.50s...", consultation_id, text)
             
         except Exception as e:
             logger.error(f"Error processing transcription: {e}")
@@ -5,14 +5,20 @@ Coordinates audio streaming, transcription, and clinical suggestions
 """
 import asyncio
 import websockets
-import json
 import logging
 import os
+import time
 from typing import Dict, Any, Optional
 from datetime import datetime
 from aiohttp import web
 
+try:
+    import uvloop  # libuv-based event loop, much cheaper per socket event than the default selector loop
+except ImportError:
+    uvloop = None
+
 # Import our modules
+import json_utils
 from conversation_state import session_manager, ConsultationType, periodic_cleanup
 from telesalud_integration import assistant_engine
 from parakeet_client import create_audio_forwarder
@@ -32,7 +38,20 @@ class RealtimeAssistantServer:
         self.http_port = int(os.environ.get("REALTIME_HTTP_PORT", 9093))
         self.host = os.environ.get("REALTIME_HOST", "0.0.0.0")
         self.active_connections = {}  # consultation_id -> websocket
+        self.ws_to_consultation = {}  # websocket -> consultation_id, so audio frames don't scan active_connections
         self.audio_forwarders = {}    # consultation_id -> AudioForwarder
+        self.background_tasks = set()  # Strong references so running tasks are not garbage collected
+        # Serialized /health body and the second it was built in; probes within that second share it
+        self._health_second = None
+        self._health_body = ""
+        
+        # Control message type -> handler(websocket, data)
+        self.control_handlers = {
+            "start_session": self.start_consultation_session,
+            "end_session": self.end_consultation_session,
+            "provider_question": self.handle_provider_question,
+            "ping": self.send_pong,
+        }
         
         # Set up suggestion callback
         assistant_engine.add_suggestion_callback(self.send_suggestion_to_telesalud)
@@ -43,17 +62,23 @@ class RealtimeAssistantServer:
         logger.info(f"Starting HTTP health check server on {self.host}:{self.http_port}")
         
         # Start background tasks
-        asyncio.create_task(assistant_engine.start_processing_queue())
-        asyncio.create_task(periodic_cleanup())
+        self.start_background_task(periodic_cleanup())
         
         # Start HTTP server for health checks
-        asyncio.create_task(self.start_http_server())
+        await self.start_http_server()
         
         # Start WebSocket server
         async with websockets.serve(self.handle_connection, self.host, self.port):
             logger.info("Real-Time Clinical Assistant Server is running")
             await asyncio.Future()  # Run forever
     
+    def start_background_task(self, coro):
+        """Run a coroutine as a task the server keeps a reference to until it finishes"""
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
+    
     async def start_http_server(self):
         """Start HTTP server for health checks"""
         app = web.Application()
@@ -68,8 +93,11 @@ class RealtimeAssistantServer:
     
     async def http_health_check(self, request):
         """HTTP health check endpoint"""
-        status = await self.get_server_status()
-        return web.json_response(status)
+        second = int(time.time())
+        if second != self._health_second:
+            self._health_body = json_utils.dumps(await self.get_server_status())
+            self._health_second = second
+        return web.Response(text=self._health_body, content_type="application/json")
     
     async def http_list_sessions(self, request):
         """HTTP endpoint to list active sessions"""
@@ -100,10 +128,10 @@ class RealtimeAssistantServer:
                 await self.handle_audio_data(websocket, message)
             else:
                 # JSON control message
-                data = json.loads(message)
+                data = json_utils.loads(message)
                 await self.handle_control_message(websocket, data)
                 
-        except json.JSONDecodeError:
+        except json_utils.JSONDecodeError:
             logger.warning("Received invalid JSON message")
             await self.send_error(websocket, "Invalid JSON format")
         except Exception as e:
@@ -113,23 +141,18 @@ class RealtimeAssistantServer:
     async def handle_control_message(self, websocket, data: Dict[str, Any]):
         """Handle JSON control messages from telesalud"""
         message_type = data.get("type")
+        handler = self.control_handlers.get(message_type)
         
-        if message_type == "start_session":
-            await self.start_consultation_session(websocket, data)
-            
-        elif message_type == "end_session":
-            await self.end_consultation_session(websocket, data)
-            
-        elif message_type == "provider_question":
-            await self.handle_provider_question(websocket, data)
-            
-        elif message_type == "ping":
-            await self.send_message(websocket, {"type": "pong", "timestamp": datetime.now().isoformat()})
-            
+        if handler:
+            await handler(websocket, data)
         else:
             logger.warning(f"Unknown message type: {message_type}")
             await self.send_error(websocket, f"Unknown message type: {message_type}")
     
+    async def send_pong(self, websocket, data: Dict[str, Any]):
+        """Answer a keepalive ping"""
+        await self.send_message(websocket, {"type": "pong", "timestamp": datetime.now()})
+    
     async def start_consultation_session(self, websocket, data: Dict[str, Any]):
         """Start a new consultation session"""
         try:
@@ -152,8 +175,12 @@ class RealtimeAssistantServer:
             # Start audio forwarder
             await audio_forwarder.start()
             
-            # Store connections
+            # Store connections (a reconnect replaces the consultation's previous websocket)
+            previous = self.active_connections.get(consultation_id)
+            if previous is not None and previous is not websocket:
+                self.ws_to_consultation.pop(previous, None)
             self.active_connections[consultation_id] = websocket
+            self.ws_to_consultation[websocket] = consultation_id
             self.audio_forwarders[consultation_id] = audio_forwarder
             
             # Send confirmation
@@ -161,7 +188,7 @@ class RealtimeAssistantServer:
                 "type": "session_started",
                 "consultation_id": consultation_id,
                 "consultation_type": consultation_type,
-                "timestamp": datetime.now().isoformat()
+                "timestamp": datetime.now()
             })
             
             logger.info(f"Started consultation session: {consultation_id} (type: {consultation_type})")
@@ -181,24 +208,24 @@ class RealtimeAssistantServer:
                     await self.audio_forwarders[consultation_id].stop()
                     del self.audio_forwarders[consultation_id]
                 
-                # Get session summary and clean up session from manager
-                session = session_manager.get_session(consultation_id)
-                summary = session.get_session_summary() if session else {}
+                # Stop analysing statements for this consultation
+                assistant_engine.cancel_consultation(consultation_id)
                 
-                # Remove session from session manager
-                if consultation_id in session_manager.active_sessions:
-                    del session_manager.active_sessions[consultation_id]
+                # Remove session from session manager and summarize it
+                session = session_manager.remove_session(consultation_id)
+                summary = session.get_session_summary() if session else {}
+                if session:
                     logger.info(f"Removed session {consultation_id} from session manager")
                 
                 # Clean up connection
-                del self.active_connections[consultation_id]
+                self.forget_connection(consultation_id)
                 
                 # Send confirmation with summary
                 await self.send_message(websocket, {
                     "type": "session_ended",
                     "consultation_id": consultation_id,
                     "session_summary": summary,
-                    "timestamp": datetime.now().isoformat()
+                    "timestamp": datetime.now()
                 })
                 
                 logger.info(f"Ended consultation session: {consultation_id}")
@@ -216,7 +243,7 @@ class RealtimeAssistantServer:
             session = session_manager.get_session(consultation_id)
             if session:
                 await session.add_provider_statement(question_text)
-                logger.info(f"Added provider question to session {consultation_id}")
+                logger.info("Added provider question to session %s", consultation_id)
             
         except Exception as e:
             logger.error(f"Error handling provider question: {e}")
@@ -225,11 +252,7 @@ class RealtimeAssistantServer:
         """Handle incoming audio data"""
         try:
             # Find consultation ID for this websocket
-            consultation_id = None
-            for cid, ws in self.active_connections.items():
-                if ws == websocket:
-                    consultation_id = cid
-                    break
+            consultation_id = self.ws_to_consultation.get(websocket)
             
             if not consultation_id:
                 logger.warning("Received audio data from unregistered connection")
@@ -252,19 +275,19 @@ class RealtimeAssistantServer:
                     "type": "clinical_suggestion",
                     "consultation_id": consultation_id,
                     "suggestions": suggestions,
-                    "timestamp": datetime.now().isoformat()
+                    "timestamp": datetime.now()
                 }
                 
                 await self.send_message(websocket, message)
-                logger.info(f"Sent clinical suggestion to consultation {consultation_id}")
+                logger.info("Sent clinical suggestion to consultation %s", consultation_id)
             
         except Exception as e:
             logger.error(f"Error sending suggestion: {e}")
     
     async def send_message(self, websocket, message: Dict[str, Any]):
-        """Send JSON message to websocket"""
+        """Send JSON message to websocket (datetime values are serialized as ISO 8601 by json_utils)"""
         try:
-            await websocket.send(json.dumps(message))
+            await websocket.send(json_utils.dumps(message))
         except Exception as e:
             logger.error(f"Error sending message: {e}")
     
@@ -273,18 +296,20 @@ class RealtimeAssistantServer:
         await self.send_message(websocket, {
             "type": "error",
             "message": error_message,
-            "timestamp": datetime.now().isoformat()
+            "timestamp": datetime.now()
         })
     
+    def forget_connection(self, consultation_id: str):
+        """Drop a consultation's websocket from both connection maps"""
+        websocket = self.active_connections.pop(consultation_id, None)
+        if websocket is not None and self.ws_to_consultation.get(websocket) == consultation_id:
+            del self.ws_to_consultation[websocket]
+    
     async def cleanup_connection(self, websocket):
         """Clean up connection when websocket closes"""
         try:
             # Find and remove connection
-            consultation_id = None
-            for cid, ws in self.active_connections.items():
-                if ws == websocket:
-                    consultation_id = cid
-                    break
+            consultation_id = self.ws_to_consultation.get(websocket)
             
             if consultation_id:
                 # Stop audio forwarder
@@ -293,7 +318,7 @@ class RealtimeAssistantServer:
                     del self.audio_forwarders[consultation_id]
                 
                 # Remove connection
-                del self.active_connections[consultation_id]
+                self.forget_connection(consultation_id)
                 
                 logger.info(f"Cleaned up connection for consultation {consultation_id}")
             
@@ -306,6 +331,7 @@ class RealtimeAssistantServer:
             "status": "running",
             "active_sessions": len(self.active_connections),
             "audio_forwarders": len(self.audio_forwarders),
+            "pending_statements": assistant_engine.pending_statements(),
             "timestamp": datetime.now().isoformat(),
             "all_sessions": session_manager.get_all_active_sessions()
         }
@@ -320,6 +346,11 @@ async def main():
     except Exception as e:
         logger.error(f"Server error: {e}")
         raise
+    finally:
+        await assistant_engine.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
\ No newline at end of file
@@ -5,15 +5,44 @@ Handles communication with telesalud's Ollama endpoints and WebSocket notificati
 """
 import os
 import json
+import time
+import random
 import asyncio
 import aiohttp
 import logging
+from collections import OrderedDict, deque
+import json_utils
 from typing import Dict, List, Optional, Any
 from datetime import datetime
 from conversation_state import ConversationStateManager, ConsultationType
 
 logger = logging.getLogger(__name__)
 
+# Wait for the patient to pause this long before analysing, so consecutive ASR segments go to one call (0 disables)
+STATEMENT_DEBOUNCE_SECONDS = float(os.environ.get("STATEMENT_DEBOUNCE_MS", 300)) / 1000
+# Statements a consultation may have waiting while its analysis is in flight; beyond this the oldest are merged
+MAX_PENDING_STATEMENTS = max(2, int(os.environ.get("MAX_PENDING_STATEMENTS", 64)))
+
+# Transient upstream failures are retried this many times with exponential backoff and jitter
+HTTP_RETRIES = 3
+HTTP_RETRY_STATUSES = frozenset({429, 502, 503, 504})
+HTTP_RETRY_BACKOFF_SECONDS = 0.3
+HTTP_RETRY_MAX_DELAY_SECONDS = 4.0
+
+# Consultation metadata rarely changes during a session; reuse fetched copies for this long
+METADATA_CACHE_TTL_SECONDS = float(os.environ.get("TELESALUD_METADATA_TTL_SEC", 300))
+METADATA_CACHE_SIZE = 1024
+
+# Short filler replies ("yeah", "I don't know") repeat within a consultation and get the same analysis;
+# reuse it instead of calling the LLM again. TELESALUD_STATEMENT_CACHE=0 disables this.
+STATEMENT_CACHE_ENABLED = os.environ.get("TELESALUD_STATEMENT_CACHE", "1") != "0"
+STATEMENT_CACHE_TTL_SECONDS = float(os.environ.get("TELESALUD_STATEMENT_CACHE_TTL_SEC", 600))
+STATEMENT_CACHE_MAX_CHARS = 40  # Longer statements depend on context too much to reuse an analysis
+STATEMENT_CACHE_SIZE = 4096
+
+# A suggestion callback (a websocket send) taking longer than this is abandoned so the consultation's worker moves on
+SUGGESTION_CALLBACK_TIMEOUT_SECONDS = float(os.environ.get("SUGGESTION_CALLBACK_TIMEOUT_SEC", 2))
+
 class TelesaludAPIClient:
     def __init__(self):
         self.base_url = os.environ.get("TELESALUD_API_BASE_URL", "http://official-staging-telehealth-web-1")
@@ -32,6 +61,92 @@ class TelesaludAPIClient:
             ConsultationType.DEPRESSION: "/api/ollama/general-medical",  # Use general for now
             ConsultationType.ANXIETY: "/api/ollama/general-medical"      # Use general for now
         }
+        # Full analysis URL per consultation type, built once
+        self.analysis_urls = {
+            consultation_type: f"{self.base_url}{endpoint}"
+            for consultation_type, endpoint in self.ollama_endpoints.items()
+        }
+        self.metadata_url = f"{self.base_url}/api/videoconsultation/data"
+        
+        # One pooled session for every consultation; created lazily because it must belong to the running loop
+        self._client_session: Optional[aiohttp.ClientSession] = None
+        
+        # consultation_id -> (expires_at, metadata), least recently used first
+        self._metadata_cache: "OrderedDict[str, tuple]" = OrderedDict()
+        # (consultation_id, normalized statement) -> (expires_at, analysis), least recently used first.
+        # Scoped to the consultation so one patient's analysis is never returned for another.
+        self._analysis_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+        
+        # consultation_id -> metadata fetch in progress, shared by concurrent callers
+        self._metadata_fetches: Dict[str, asyncio.Task] = {}
+    
+    async def get_client_session(self) -> aiohttp.ClientSession:
+        """Return the shared keep-alive HTTP session"""
+        if self._client_session is None or self._client_session.closed:
+            # Keep idle connections longer than aiohttp's 15 s default so they survive the pauses between patient statements
+            connector = aiohttp.TCPConnector(
+                limit=int(os.environ.get("TELESALUD_HTTP_CONNECTIONS", 20)),
+                keepalive_timeout=75
+            )
+            self._client_session = aiohttp.ClientSession(
+                connector=connector,
+                headers=self.headers,
+                # Shared by every consultation, so don't let cookies from one response ride along on the next
+                cookie_jar=aiohttp.DummyCookieJar(),
+                json_serialize=json_utils.dumps,  # orjson for request payloads instead of stdlib json
+                timeout=aiohttp.ClientTimeout(total=float(os.environ.get("TELESALUD_HTTP_TIMEOUT", 30)))
+            )
+        return self._client_session
+    
+    async def close(self):
+        """Close the shared HTTP session"""
+        if self._client_session is not None and not self._client_session.closed:
+            await self._client_session.close()
+    
+    async def _request(self, method: str, url: str, **kwargs) -> aiohttp.ClientResponse:
+        """Send a request, retrying connection errors and 429/502/503/504 responses with backoff"""
+        client_session = await self.get_client_session()
+        for attempt in range(HTTP_RETRIES + 1):
+            delay = min(HTTP_RETRY_BACKOFF_SECONDS * 2 ** attempt, HTTP_RETRY_MAX_DELAY_SECONDS)
+            delay += random.uniform(0, HTTP_RETRY_BACKOFF_SECONDS)
+            try:
+                response = await client_session.request(method, url, **kwargs)
+            except aiohttp.ClientConnectionError as e:
+                if attempt == HTTP_RETRIES:
+                    raise
+                logger.warning(f"Connection error calling {url} ({e}), retrying in {delay:.1f}s")
+            else:
+                if response.status not in HTTP_RETRY_STATUSES or attempt == HTTP_RETRIES:
+                    return response
+                # Honour the server's Retry-After (in seconds) when it sends one, within the same cap
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = min(float(retry_after), HTTP_RETRY_MAX_DELAY_SECONDS)
+                response.release()
+                logger.warning(f"API returned {response.status} for {url}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+    
+    @staticmethod
+    def _analysis_cache_key(session: ConversationStateManager, patient_statement: str) -> Optional[tuple]:
+        """Cache key for a short statement, or None when it shouldn't be cached"""
+        normalized = patient_statement.strip().lower()
+        if STATEMENT_CACHE_ENABLED and len(normalized) <= STATEMENT_CACHE_MAX_CHARS:
+            return (session.consultation_id, normalized)
+        return None
+    
+    def get_cached_analysis(self, session: ConversationStateManager, patient_statement: str) -> Optional[Dict[str, Any]]:
+        """Return a recent analysis of the same statement in this consultation, or None"""
+        cache_key = self._analysis_cache_key(session, patient_statement)
+        cached = self._analysis_cache.get(cache_key) if cache_key is not None else None
+        if cached is None:
+            return None
+        expires_at, result = cached
+        if expires_at <= time.monotonic():
+            del self._analysis_cache[cache_key]
+            return None
+        self._analysis_cache.move_to_end(cache_key)
+        logger.debug("Reusing analysis of %r for consultation %s", cache_key[1], session.consultation_id)
+        return result
     
     async def analyze_patient_statement(self, session: ConversationStateManager, patient_statement: str) -> Optional[Dict[str, Any]]:
         """
@@ -43,12 +158,13 @@ class TelesaludAPIClient:
             
         Returns:
             Analysis results with question suggestions and indicators
+            (short statements are also cached for get_cached_analysis)
         """
+        cache_key = self._analysis_cache_key(session, patient_statement)
+        
         try:
-            endpoint = self.ollama_endpoints.get(session.consultation_type, 
-                                               self.ollama_endpoints[ConsultationType.GENERAL])
-            
-            url = f"{self.base_url}{endpoint}"
+            url = self.analysis_urls.get(session.consultation_type,
+                                         self.analysis_urls[ConsultationType.GENERAL])
             
             # Prepare request payload
             payload = {
@@ -62,18 +178,22 @@ class TelesaludAPIClient:
                 "questions_asked_count": session.evaluation_progress.questions_asked
             }
             
-            logger.info(f"Sending analysis request to {url} for consultation {session.consultation_id}")
+            logger.info("Sending analysis request to %s for consultation %s", url, session.consultation_id)
             
-            async with aiohttp.ClientSession() as client_session:
-                async with client_session.post(url, json=payload, headers=self.headers) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        logger.info(f"Received analysis response for consultation {session.consultation_id}")
-                        return result
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"API error {response.status}: {error_text}")
-                        return None
+            async with await self._request("POST", url, json=payload) as response:
+                if response.status == 200:
+                    result = await response.json(loads=json_utils.loads)
+                    logger.info("Received analysis response for consultation %s", session.consultation_id)
+                    if cache_key is not None:
+                        self._analysis_cache[cache_key] = (time.monotonic() + STATEMENT_CACHE_TTL_SECONDS, result)
+                        self._analysis_cache.move_to_end(cache_key)
+                        if len(self._analysis_cache) > STATEMENT_CACHE_SIZE:
+                            self._analysis_cache.popitem(last=False)
+                    return result
+                else:
+                    error_text = await response.text()
+                    logger.error(f"API error {response.status}: {error_text}")
+                    return None
                         
         except Exception as e:
             logger.error(f"Error calling telesalud analysis API: {e}")
@@ -89,86 +209,89 @@ class TelesaludAPIClient:
         Returns:
             Consultation metadata or None if error
         """
+        cached = self._metadata_cache.get(consultation_id)
+        if cached is not None:
+            expires_at, data = cached
+            if expires_at > time.monotonic():
+                self._metadata_cache.move_to_end(consultation_id)
+                return data
+            del self._metadata_cache[consultation_id]
+        
+        # Concurrent misses for the same consultation wait on one request instead of each sending their own
+        fetch = self._metadata_fetches.get(consultation_id)
+        if fetch is None:
+            fetch = asyncio.create_task(self._fetch_consultation_metadata(consultation_id))
+            self._metadata_fetches[consultation_id] = fetch
+            fetch.add_done_callback(lambda _: self._metadata_fetches.pop(consultation_id, None))
+        # Shielded so one caller being cancelled doesn't cancel the fetch for the others
+        return await asyncio.shield(fetch)
+    
+    async def _fetch_consultation_metadata(self, consultation_id: str) -> Optional[Dict[str, Any]]:
+        """Request consultation metadata and cache it on success"""
         try:
-            url = f"{self.base_url}/api/videoconsultation/data"
+            url = self.metadata_url
             params = {"vc": consultation_id}
             
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, params=params, headers=self.headers) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        return data
-                    else:
-                        logger.error(f"Failed to get consultation metadata: {response.status}")
-                        return None
+            async with await self._request("GET", url, params=params) as response:
+                if response.status == 200:
+                    data = await response.json(loads=json_utils.loads)
+                    self._metadata_cache[consultation_id] = (time.monotonic() + METADATA_CACHE_TTL_SECONDS, data)
+                    self._metadata_cache.move_to_end(consultation_id)
+                    if len(self._metadata_cache) > METADATA_CACHE_SIZE:
+                        self._metadata_cache.popitem(last=False)
+                    return data
+                else:
+                    logger.error(f"Failed to get consultation metadata: {response.status}")
+                    return None
                         
         except Exception as e:
             logger.error(f"Error getting consultation metadata: {e}")
             return None
+    
+    def invalidate_metadata(self, consultation_id: str):
+        """Forget cached metadata for a consultation"""
+        self._metadata_cache.pop(consultation_id, None)
+
+# Suggestion layout per consultation type: (type, title, {suggestion key: analysis key});
+# types without an entry use the general medical layout
+SUGGESTION_FORMATS = {
+    ConsultationType.AUTISM: ("autism_assessment", "Autism Assessment Guidance", {
+        "next_questions": "next_questions",
+        "observed_indicators": "autism_indicators",
+        "areas_to_explore": "focus_areas",
+        "assessment_tools": "recommended_tools"
+    }),
+    ConsultationType.ADHD: ("adhd_evaluation", "ADHD Evaluation Guidance", {
+        "next_questions": "next_questions",
+        "symptom_indicators": "adhd_indicators",
+        "functional_areas": "functional_impairment",
+        "rating_scales": "recommended_scales"
+    }),
+    ConsultationType.GENERAL: ("general_medical", "Clinical Assessment Guidance", {
+        "next_questions": "next_questions",
+        "clinical_indicators": "indicators",
+        "diagnostic_considerations": "differential_diagnosis",
+        "recommended_assessments": "recommended_assessments"
+    })
+}
 
 class SuggestionFormatter:
     """Format AI analysis results into actionable suggestions for providers"""
     
     @staticmethod
-    def format_autism_suggestions(analysis: Dict[str, Any]) -> Dict[str, Any]:
-        """Format autism assessment suggestions"""
-        return {
-            "type": "autism_assessment",
-            "priority": analysis.get("priority", "medium"),
-            "title": "Autism Assessment Guidance",
-            "suggestions": {
-                "next_questions": analysis.get("next_questions", []),
-                "observed_indicators": analysis.get("autism_indicators", []),
-                "areas_to_explore": analysis.get("focus_areas", []),
-                "assessment_tools": analysis.get("recommended_tools", [])
-            },
-            "clinical_notes": analysis.get("clinical_observations", ""),
-            "timestamp": datetime.now().isoformat()
-        }
-    
-    @staticmethod
-    def format_adhd_suggestions(analysis: Dict[str, Any]) -> Dict[str, Any]:
-        """Format ADHD evaluation suggestions"""
-        return {
-            "type": "adhd_evaluation", 
-            "priority": analysis.get("priority", "medium"),
-            "title": "ADHD Evaluation Guidance",
-            "suggestions": {
-                "next_questions": analysis.get("next_questions", []),
-                "symptom_indicators": analysis.get("adhd_indicators", []),
-                "functional_areas": analysis.get("functional_impairment", []),
-                "rating_scales": analysis.get("recommended_scales", [])
-            },
-            "clinical_notes": analysis.get("clinical_observations", ""),
-            "timestamp": datetime.now().isoformat()
-        }
-    
-    @staticmethod
-    def format_general_suggestions(analysis: Dict[str, Any]) -> Dict[str, Any]:
-        """Format general medical consultation suggestions"""
+    def format_suggestions(session: ConversationStateManager, analysis: Dict[str, Any]) -> Dict[str, Any]:
+        """Format suggestions based on consultation type"""
+        suggestion_type, title, fields = SUGGESTION_FORMATS.get(
+            session.consultation_type, SUGGESTION_FORMATS[ConsultationType.GENERAL]
+        )
         return {
-            "type": "general_medical",
+            "type": suggestion_type,
             "priority": analysis.get("priority", "medium"),
-            "title": "Clinical Assessment Guidance", 
-            "suggestions": {
-                "next_questions": analysis.get("next_questions", []),
-                "clinical_indicators": analysis.get("indicators", []),
-                "diagnostic_considerations": analysis.get("differential_diagnosis", []),
-                "recommended_assessments": analysis.get("recommended_assessments", [])
-            },
+            "title": title,
+            "suggestions": {key: analysis.get(source, []) for key, source in fields.items()},
             "clinical_notes": analysis.get("clinical_observations", ""),
             "timestamp": datetime.now().isoformat()
         }
-    
-    @classmethod
-    def format_suggestions(cls, session: ConversationStateManager, analysis: Dict[str, Any]) -> Dict[str, Any]:
-        """Format suggestions based on consultation type"""
-        if session.consultation_type == ConsultationType.AUTISM:
-            return cls.format_autism_suggestions(analysis)
-        elif session.consultation_type == ConsultationType.ADHD:
-            return cls.format_adhd_suggestions(analysis)
-        else:
-            return cls.format_general_suggestions(analysis)
 
 class ClinicalAssistantEngine:
     """Main engine for real-time clinical assistance"""
@@ -176,9 +299,17 @@ class ClinicalAssistantEngine:
     def __init__(self):
         self.telesalud_client = TelesaludAPIClient()
         self.suggestion_formatter = SuggestionFormatter()
-        self.processing_queue = asyncio.Queue()
+        # Per-consultation statement queues, each drained in order by its own worker task so a
+        # slow analysis for one consultation never delays another
+        self.processing_queues: Dict[str, deque] = {}
+        self.workers: Dict[str, asyncio.Task] = {}
+        self.last_queued_at: Dict[str, float] = {}  # consultation_id -> loop time of its latest statement
         self.suggestion_callbacks = []  # WebSocket handlers to notify
         
+    async def close(self):
+        """Release the telesalud API connections"""
+        await self.telesalud_client.close()
+    
     def add_suggestion_callback(self, callback):
         """Add callback function to receive suggestions"""
         self.suggestion_callbacks.append(callback)
@@ -194,24 +325,40 @@ class ClinicalAssistantEngine:
         Returns:
             Formatted suggestions for the provider
         """
+        return await self.process_patient_statements(session, [statement])
+    
+    async def process_patient_statements(self, session: ConversationStateManager, statements: List[str]) -> Optional[Dict[str, Any]]:
+        """
+        Process consecutive patient statements as one utterance and generate clinical suggestions
+        
+        Each statement is recorded as its own segment; the joined text is analyzed in a single call.
+        """
         try:
-            # Add statement to session
-            segment = await session.add_patient_statement(statement)
+            # Add statements to session
+            segments = [await session.add_patient_statement(statement) for statement in statements]
             
-            # Get AI analysis from telesalud
-            analysis = await self.telesalud_client.analyze_patient_statement(session, statement)
+            # Get AI analysis from telesalud; a repeated statement reuses its recent analysis
+            text = "\n".join(statements)
+            analysis = self.telesalud_client.get_cached_analysis(session, text)
+            cache_hit = analysis is not None
+            if not cache_hit:
+                analysis = await self.telesalud_client.analyze_patient_statement(session, text)
             
             if not analysis:
                 logger.warning(f"No analysis received for consultation {session.consultation_id}")
                 return None
             
-            # Mark segment as processed and update session state
-            indicators = analysis.get("indicators", [])
-            session.mark_segment_processed(segment, indicators)
+            # Mark segments as processed and update session state; indicators are counted once, on the latest segment.
+            # A reused analysis was already counted when it was first received, so it only produces suggestions.
+            indicators = [] if cache_hit else analysis.get("indicators", [])
+            for segment in segments[:-1]:
+                session.mark_segment_processed(segment)
+            session.mark_segment_processed(segments[-1], indicators)
             
             # Update evaluation progress if specific areas were assessed
-            for area in analysis.get("areas_assessed", []):
-                session.update_evaluation_progress(area, indicators)
+            if not cache_hit:
+                for area in analysis.get("areas_assessed", []):
+                    session.update_evaluation_progress(area, indicators)
             
             # Format suggestions for provider
             formatted_suggestions = self.suggestion_formatter.format_suggestions(session, analysis)
@@ -219,7 +366,7 @@ class ClinicalAssistantEngine:
             # Notify all registered callbacks (WebSocket connections)
             await self.notify_suggestion_callbacks(session.consultation_id, formatted_suggestions)
             
-            logger.info(f"Generated suggestions for consultation {session.consultation_id}")
+            logger.info("Generated suggestions for consultation %s", session.consultation_id)
             
             return formatted_suggestions
             
@@ -228,34 +375,74 @@ class ClinicalAssistantEngine:
             return None
     
     async def notify_suggestion_callbacks(self, consultation_id: str, suggestions: Dict[str, Any]):
-        """Notify all registered callbacks about new suggestions"""
-        for callback in self.suggestion_callbacks:
-            try:
-                await callback(consultation_id, suggestions)
-            except Exception as e:
-                logger.error(f"Error in suggestion callback: {e}")
+        """Notify all registered callbacks about new suggestions, concurrently so a slow one doesn't hold up the rest"""
+        await asyncio.gather(*(
+            self._notify_callback(callback, consultation_id, suggestions)
+            for callback in self.suggestion_callbacks
+        ))
     
-    async def start_processing_queue(self):
-        """Start background processing of queued statements"""
-        while True:
-            try:
-                # Wait for new items in the processing queue
-                session, statement = await self.processing_queue.get()
-                
-                # Process the statement
-                await self.process_patient_statement(session, statement)
-                
-                # Mark task as done
-                self.processing_queue.task_done()
+    async def _notify_callback(self, callback, consultation_id: str, suggestions: Dict[str, Any]):
+        try:
+            await asyncio.wait_for(callback(consultation_id, suggestions), SUGGESTION_CALLBACK_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.error(f"Suggestion callback timed out after {SUGGESTION_CALLBACK_TIMEOUT_SECONDS}s for consultation {consultation_id}")
+        except Exception as e:
+            logger.error(f"Error in suggestion callback: {e}")
+    
+    async def _consultation_worker(self, consultation_id: str, queue: deque):
+        """Process one consultation's queued statements in order, exiting once the queue is empty"""
+        loop = asyncio.get_running_loop()
+        try:
+            while queue:
+                # Let the patient finish speaking, then analyse everything queued so far as one utterance
+                while (quiet := self.last_queued_at[consultation_id] + STATEMENT_DEBOUNCE_SECONDS - loop.time()) > 0:
+                    await asyncio.sleep(quiet)
                 
-            except Exception as e:
-                logger.error(f"Error in processing queue: {e}")
-                await asyncio.sleep(1)  # Brief pause before continuing
+                batch = list(queue)
+                queue.clear()
+                try:
+                    await self.process_patient_statements(batch[-1][0], [statement for _, statement in batch])
+                except Exception as e:
+                    logger.error(f"Error in processing queue: {e}")
+        finally:
+            # No await between the empty check and here, so a statement queued meanwhile starts a new worker
+            if self.workers.get(consultation_id) is asyncio.current_task():
+                del self.workers[consultation_id]
+                del self.processing_queues[consultation_id]
+                del self.last_queued_at[consultation_id]
     
     async def queue_patient_statement(self, session: ConversationStateManager, statement: str):
         """Queue a patient statement for processing"""
-        await self.processing_queue.put((session, statement))
-        logger.debug(f"Queued statement for processing: {statement[:50]}...")
+        consultation_id = session.consultation_id
+        queue = self.processing_queues.get(consultation_id)
+        if queue is None:
+            queue = self.processing_queues[consultation_id] = deque()
+        if len(queue) >= MAX_PENDING_STATEMENTS:
+            # They are analysed together anyway; merging keeps the text without growing the backlog
+            _, oldest = queue.popleft()
+            merged_session, next_oldest = queue.popleft()
+            queue.appendleft((merged_session, f"{oldest}\n{next_oldest}"))
+            logger.warning(f"Analysis backlog full for consultation {consultation_id}, merged its oldest pending statements")
+        queue.append((session, statement))
+        self.last_queued_at[consultation_id] = asyncio.get_running_loop().time()
+        if consultation_id not in self.workers:
+            self.workers[consultation_id] = asyncio.create_task(
+                self._consultation_worker(consultation_id, queue), name=f"analyze:{consultation_id}"
+            )
+        logger.debug("Queued statement for processing: %.50s...", statement)
+    
+    def pending_statements(self) -> int:
+        """Number of statements waiting for analysis across all consultations"""
+        return sum(len(queue) for queue in self.processing_queues.values())
+    
+    def cancel_consultation(self, consultation_id: str):
+        """Drop a consultation's pending statements and stop its worker"""
+        self.processing_queues.pop(consultation_id, None)
+        self.last_queued_at.pop(consultation_id, None)
+        self.telesalud_client.invalidate_metadata(consultation_id)
+        worker = self.workers.pop(consultation_id, None)
+        if worker is not None:
+            worker.cancel()
 
 # Global assistant engine instance
 assistant_engine = ClinicalAssistantEngine()
\ No newline at end of file